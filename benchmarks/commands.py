@@ -0,0 +1,110 @@
+#! /usr/bin/env python3
+"""
+Command benchmark: times scoop commands against libraries of different sizes, with feeds and media served by a local
+fake podcast host.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+$ python3 benchmarks/commands.py --sizes 1000,100000,1000000 --output results.json
+
+Each command is run as its own scoop process, so times include interpreter startup. Results are written as JSON so
+runs from different commits can be compared.
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+import dbqueries
+import fakehost
+
+repodir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+scoopbin = os.path.join(repodir, 'bin', 'scoop')
+
+def preparelibrary(dbfile, size, downloaddir):
+    """ Create a library of size episodes with no work left, so that only the fake host's feeds are synced and
+    downloaded. """
+    dbobj = dbqueries.makelibrary(dbfile, max(1, size // 200), size)
+    with dbobj as conn:
+        conn.execute('UPDATE podcast SET stopped = ?', (int(time.time()),))
+        conn.execute("UPDATE dl SET status = 's' WHERE status = 'w'")
+        conn.execute("UPDATE config SET value = ? WHERE key = 'downloaddir'", (downloaddir,))
+        conn.execute("UPDATE config SET value = '0' WHERE key = 'saverss'")
+    dbobj.commit()
+    dbobj.conn.execute('ANALYZE')
+    dbobj.conn.close()
+
+def runscoop(dbfile, args):
+    env = dict(os.environ, PYTHONPATH=repodir)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, scoopbin, '--dbfile', dbfile] + args, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def benchsize(size, host, settings, workdir):
+    """ Return the command timings for a library of size episodes. """
+    dbfile = os.path.join(workdir, 'scoop-{}.db'.format(size))
+    downloaddir = os.path.join(workdir, 'media-{}'.format(size))
+    preparelibrary(dbfile, size, downloaddir)
+    playlistfile = os.path.join(workdir, 'week-{}.m3u'.format(size))
+    results = []
+    def record(name, args, repeat=1):
+        runs = [runscoop(dbfile, args) for _ in range(repeat)]
+        results.append(dict(episodes=size, command=name, runs=runs, best=min(runs)))
+        print('{:>9} {:14} {:9.3f}s'.format(size, name, min(runs)), file=sys.stderr)
+    # One-off commands that change the library.
+    record('podcast add', ['podcast', 'add', '--limit', str(settings['downloads']), host.feedurl('bench-{}'.format(size), settings['feeditems'])])
+    host.grow(settings['newitems'])
+    record('podcast sync', ['podcast', 'sync', '--force'])
+    record('dl sync', ['dl', 'sync', '--jobs', str(settings['jobs'])])
+    # Read only commands.
+    repeat = settings['repeat']
+    record('episode ls', ['episode', 'ls'], repeat)
+    record('dl ls', ['dl', 'ls'], repeat)
+    record('listgen', ['listgen', '--newerthan', '7', playlistfile], repeat)
+    return results
+
+def gitcommit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repodir, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,100000,1000000', help='comma separated library sizes, in episodes. Default: %(default)s')
+    parser.add_argument('--feeditems', default=1000, type=int, help='number of items in the added feed, 10 to 50000. Default: %(default)s')
+    parser.add_argument('--newitems', default=10, type=int, help='items published to the feed before podcast sync. Default: %(default)s')
+    parser.add_argument('--downloads', default=20, type=int, help='episodes to download from the added feed. Default: %(default)s')
+    parser.add_argument('--jobs', default=4, type=int, help='dl sync jobs. Default: %(default)s')
+    parser.add_argument('--latency', default=0.02, type=float, metavar='SECONDS', help='fake host response delay. Default: %(default)s')
+    parser.add_argument('--bandwidth', default=None, type=int, metavar='BYTES', help='fake host per response rate in bytes/s. Default: unlimited')
+    parser.add_argument('--mediasize', default=0x100000, type=int, metavar='BYTES', help='media file size. Default: %(default)s')
+    parser.add_argument('--repeat', default=3, type=int, help='runs of each read only command. Default: %(default)s')
+    parser.add_argument('--nocompress', default=False, action='store_true', help="fake host doesn't gzip feeds")
+    parser.add_argument('--output', default=None, metavar='FILE', help='write JSON results to FILE. Default: stdout')
+    args = parser.parse_args()
+    settings = dict(feeditems=args.feeditems, newitems=args.newitems, downloads=args.downloads, jobs=args.jobs, latency=args.latency, bandwidth=args.bandwidth, mediasize=args.mediasize, repeat=args.repeat, compress=not args.nocompress)
+    host = fakehost.FakeHost(latency=args.latency, bandwidth=args.bandwidth, mediasize=args.mediasize, compress=settings['compress']).start()
+    workdir = tempfile.mkdtemp()
+    try:
+        results = []
+        for size in (int(x) for x in args.sizes.split(',')):
+            results.extend(benchsize(size, host, settings, workdir))
+    finally:
+        host.stop()
+        shutil.rmtree(workdir)
+    report = dict(commit=gitcommit(), date=datetime.datetime.now().isoformat(timespec='seconds'), python=sys.version.split()[0], sqlite=sqlite3.sqlite_version, settings=settings, results=results)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
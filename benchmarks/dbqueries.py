@@ -0,0 +1,91 @@
+#! /usr/bin/env python3
+"""
+Query benchmark: times the sql module's queries on a large synthetic library, with and without the schema indexes.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+$ python3 benchmarks/dbqueries.py --episodes 100000
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from scoop import db
+from scoop import sql
+
+indexes = ['episode_podcastid_pubdate', 'dl_episodeid_status', 'dl_status_actioned']
+
+def makelibrary(dbfile, npodcasts, nepisodes):
+    """ Create a db of npodcasts with nepisodes spread between them, each episode with a download order. """
+    dbobj = db.DB(dbfile)
+    perpodcast = nepisodes // npodcasts
+    now = int(time.time())
+    for p in range(npodcasts):
+        podcast = sql.addpodcast(dbobj, dict(title='podcast {:05}'.format(p), rssurl='http://localhost/{}.rss'.format(p), description='Podcast {}'.format(p), homepage=None))
+        eps = [dict(guid='{}-{}'.format(p, e), permalink=False, title='episode {} of podcast {}'.format(e, p), description='Description {}'.format(e), mediaurl='http://localhost/{}/{}.mp3'.format(p, e), mediatype='audio/mpeg', medialength=1, pubdate=now - e * 7 * 86400, link=None) for e in range(perpodcast)]
+        episodes = sql.addepisodes(dbobj, podcast, eps)
+        # Weekly episodes, each downloaded an hour after release. Except for the newest two which are waiting, and the
+        # oldest few which are left without orders for getnewepisodes.
+        downloads = sql.adddownloads(dbobj, episodes[:-5], limit=False)
+        with dbobj as conn:
+            conn.executemany("UPDATE dl SET status = 'd', actioned = ?, filename = 'x.mp3' WHERE dlid = ?", [(e.pubdate + 3600, d.dlid) for e, d in zip(episodes[2:], downloads[2:])])
+        dbobj.commit()
+    return dbobj
+
+def timeit(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def runqueries(dbobj, repeat):
+    podcast = sql.getpodcasts(dbobj, 'podcast 00042')[0]
+    monthago = int(time.time()) - 30 * 86400
+    queries = [
+        ('getepisodes podcast', lambda: sql.getepisodes(dbobj, podcasttitle='podcast 00042')),
+        ('getnewepisodes', lambda: sql.getnewepisodes(dbobj)),
+        ('getdls waiting', lambda: sql.getdls(dbobj, statelist=['w'])),
+        ('getdls newerthan', lambda: sql.getdls(dbobj, statelist=['d'], newerthan=monthago)),
+        ('getdls podcast', lambda: sql.getdls(dbobj, podcasttitle='podcast 00042', statelist=['d'])),
+        ('getguids', lambda: sql.getguids(dbobj, podcast)),
+        ]
+    return [(name, timeit(func, repeat)) for name, func in queries]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--episodes', default=100000, type=int, help='number of episodes in the library. Default: %(default)s')
+    parser.add_argument('--podcasts', default=500, type=int, help='number of podcasts in the library. Default: %(default)s')
+    parser.add_argument('--repeat', default=3, type=int, help='best of N runs per query. Default: %(default)s')
+    args = parser.parse_args()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        indexed = os.path.join(tmpdir, 'indexed.db')
+        plain = os.path.join(tmpdir, 'plain.db')
+        makelibrary(indexed, args.podcasts, args.episodes).conn.close()
+        shutil.copy(indexed, plain)
+        plaindb = db.DB(plain)
+        with plaindb as conn:
+            for i in indexes:
+                conn.execute('DROP INDEX {}'.format(i))
+        plaindb.commit()
+        indexeddb = db.DB(indexed)
+        # Both get planner statistics, as PRAGMA optimize gathers them in regular use.
+        for d in (plaindb, indexeddb):
+            d.conn.execute('ANALYZE')
+        withidx = runqueries(indexeddb, args.repeat)
+        without = runqueries(plaindb, args.repeat)
+        print('{:24} {:>12} {:>12} {:>8}'.format('query', 'no index ms', 'indexed ms', 'speedup'))
+        for (name, a), (_, b) in zip(without, withidx):
+            print('{:24} {:12.2f} {:12.2f} {:7.1f}x'.format(name, a * 1000, b * 1000, a / b))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#! /usr/bin/env python3
+"""
+Download write path benchmark: times downloading media from the local fake podcast host, with the plain chunked read
+scoop used to have and with the current write path under each fsync policy.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+$ python3 benchmarks/dlwrite.py --mediasize 268435456 --output dlwrite.json
+
+Results give the transfer rate in MB/s and the CPU time the downloading thread used per GB. The fake host runs in its
+own thread, so its CPU time isn't counted.
+"""
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+
+import commands
+import fakehost
+
+sys.path.insert(0, commands.repodir)
+from scoop import httppool
+from scoop import sql
+from scoop import scoop
+
+def plaindownload(pool, url, path):
+    """ Download url to path the way scoop used to, reading 16 KiB bytes objects. Returns the size. """
+    urlfp = pool.open(url)
+    try:
+        hasher = hashlib.sha256()
+        with open(path, 'wb') as f:
+            while True:
+                chunk = urlfp.read(0x4000)
+                if not chunk:
+                    break
+                f.write(chunk)
+                hasher.update(chunk)
+            return f.tell()
+    finally:
+        urlfp.close()
+
+def scoopdownload(pool, url, destdir, fsync):
+    dl = sql.Download(podtitle='bench', eptitle='bench', mediaurl=url, episodeid=1)
+    media = scoop.downloadepisode(pool, dl, destdir, fsync=fsync)
+    os.unlink(os.path.join(destdir, media.filename))
+    return media.size
+
+def timerun(func):
+    """ Return the wall and thread CPU seconds taken by func, and its result. """
+    start = time.perf_counter()
+    cpustart = time.thread_time()
+    result = func()
+    return time.perf_counter() - start, time.thread_time() - cpustart, result
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--mediasize', default=0x4000000, type=int, metavar='BYTES', help='size of the media file. Default: %(default)s')
+    parser.add_argument('--repeat', default=5, type=int, help='downloads with each write path. Default: %(default)s')
+    parser.add_argument('--dir', default=None, metavar='DIR', help='write files in DIR, eg to test a particular disk. Default: a temporary directory')
+    parser.add_argument('--output', default=None, metavar='FILE', help='write JSON results to FILE. Default: stdout')
+    args = parser.parse_args()
+    host = fakehost.FakeHost(mediasize=args.mediasize).start()
+    workdir = tempfile.mkdtemp(dir=args.dir)
+    pool = httppool.Pool('Scoop benchmark')
+    url = '{}/media/bench.mp3'.format(host.url)
+    paths = [
+        ('plain read', lambda: plaindownload(pool, url, os.path.join(workdir, 'plain.mp3'))),
+        ('readinto', lambda: scoopdownload(pool, url, workdir, None)),
+        ('readinto fsync file', lambda: scoopdownload(pool, url, workdir, 0)),
+        ('readinto fsync 16', lambda: scoopdownload(pool, url, workdir, 16)),
+        ]
+    results = []
+    try:
+        for name, func in paths:
+            runs = [timerun(func) for _ in range(args.repeat)]
+            size = runs[0][2]
+            seconds = [t for t, _, _ in runs]
+            cpu = [c for _, c, _ in runs]
+            best = min(seconds)
+            results.append(dict(path=name, bytes=size, runs=seconds, cpu=cpu, best=best, mbps=size / best / 1e6, cpupergb=statistics.median(cpu) / size * 1e9))
+            print('{:20} {:8.1f} MB/s {:8.2f} CPU s/GB'.format(name, size / best / 1e6, statistics.median(cpu) / size * 1e9), file=sys.stderr)
+    finally:
+        pool.close()
+        host.stop()
+        shutil.rmtree(workdir)
+    report = dict(commit=commands.gitcommit(), date=datetime.datetime.now().isoformat(timespec='seconds'), python=sys.version.split()[0], sqlite=sqlite3.sqlite_version,
+                  mediasize=args.mediasize, results=results)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
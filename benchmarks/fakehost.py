@@ -0,0 +1,204 @@
+#! /usr/bin/env python3
+"""
+Fake podcast host: serves synthetic rss feeds and media over local HTTP, for benchmarks.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+$ python3 benchmarks/fakehost.py --port 8000 --latency 0.05 --bandwidth 1048576
+
+Paths:
+    /feed/NAME?items=N          rss feed of the newest N items of podcast NAME.
+    /media/FILE?size=B          B bytes of media. Range requests are supported.
+    /redir/FILE?size=B          302 redirect to the blob url of FILE.
+    /blob/ID?size=B&rscd=...    media named by an Azure style rscd query parameter, eg
+                                rscd=attachment%3B%20filename%3D%22FILE%22
+
+Feed item media urls take turns between the media, redir and blob styles. Feeds are gzipped for clients that accept it,
+unless compression is turned off.
+"""
+import argparse
+import email.utils
+import gzip
+import http.server
+import re
+import threading
+import time
+import urllib.parse as up
+import xml.sax.saxutils as su
+import zlib
+
+# Item pubdates are an hour apart, counting from here.
+epoch = 1500000000
+
+class FakeHost:
+    """ Local HTTP podcast host. latency is the delay in seconds before each response, bandwidth the per-response
+    transfer rate in bytes per second, None for unlimited. compress gzips feeds for clients that accept it. """
+
+    def __init__(self, port=0, latency=0, bandwidth=None, mediasize=0x10000, compress=True):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.mediasize = mediasize
+        self.compress = compress
+        # Number of items every feed has gained since start, see grow().
+        self.offset = 0
+        self._feeds = {}
+        self._lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        self.server.fakehost = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return 'http://{}:{}'.format(host, port)
+
+    def feedurl(self, name, items):
+        return '{}/feed/{}?items={}'.format(self.url, up.quote(name), items)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def grow(self, n):
+        """ Publish n new items on every feed. """
+        with self._lock:
+            self.offset += n
+            self._feeds.clear()
+
+    def feed(self, name, items):
+        """ Return the rss bytes, the rss gzipped and the etag of feed name with items items. """
+        with self._lock:
+            offset = self.offset
+            try:
+                return self._feeds[(name, items)]
+            except KeyError:
+                pass
+        etag = '"{}-{}-{}"'.format(name, items, offset)
+        body = makefeed(self.url, name, items, offset).encode('utf-8')
+        feed = (body, gzip.compress(body), etag)
+        with self._lock:
+            self._feeds[(name, items)] = feed
+        return feed
+
+def mediaurl(base, name, i):
+    filename = up.quote('{}-{}.mp3'.format(name, i))
+    style = i % 3
+    if style == 0:
+        return '{}/media/{}'.format(base, filename)
+    elif style == 1:
+        return '{}/redir/{}'.format(base, filename)
+    return blobpath(base, name, i)
+
+def blobpath(base, name, i):
+    rscd = up.quote('attachment; filename="{}-{}.mp3"'.format(name, i))
+    blobid = zlib.crc32('{}-{}'.format(name, i).encode('utf-8'))
+    return '{}/blob/{:08x}?sv=2015-04-05&sr=b&sig=x&rscd={}'.format(base, blobid, rscd)
+
+def makefeed(base, name, items, offset):
+    """ Return rss text for the newest items items of podcast name. """
+    esc = su.escape
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n<rss version="2.0"><channel>',
+             '<title>{}</title><link>{}/</link><description>Synthetic podcast {}</description>'.format(esc(name), base, esc(name))]
+    for i in range(offset + items - 1, offset - 1, -1):
+        parts.append('<item><title>{} episode {}</title><description>Episode {} of {}, a synthetic benchmark podcast.</description>'
+                     '<guid isPermaLink="false">{}-{}</guid><pubDate>{}</pubDate>'
+                     '<enclosure url="{}" length="0" type="audio/mpeg"/></item>\n'.format(
+                         esc(name), i, i, esc(name), esc(name), i, email.utils.formatdate(epoch + i * 3600, usegmt=True), esc(mediaurl(base, name, i))))
+    parts.append('</channel></rss>\n')
+    return ''.join(parts)
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def handle(self):
+        try:
+            super().handle()
+        except ConnectionError:
+            # Scoop hangs up part way through feeds once it reaches known episodes.
+            pass
+
+    def do_GET(self):
+        host = self.server.fakehost
+        if host.latency:
+            time.sleep(host.latency)
+        url = up.urlsplit(self.path)
+        query = up.parse_qs(url.query)
+        kind, _, rest = url.path.lstrip('/').partition('/')
+        if kind == 'feed':
+            body, gzipbody, etag = host.feed(up.unquote(rest), int(query.get('items', ['100'])[0]))
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if host.compress and 'gzip' in self.headers.get('Accept-Encoding', ''):
+                self.sendbody(gzipbody, 'application/rss+xml', etag=etag, encoding='gzip')
+            else:
+                self.sendbody(body, 'application/rss+xml', etag=etag)
+        elif kind == 'redir':
+            name, _, i = up.unquote(rest).rpartition('.')[0].rpartition('-')
+            self.send_response(302)
+            self.send_header('Location', blobpath('', name, int(i)))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        elif kind in ('media', 'blob'):
+            size = int(query.get('size', [host.mediasize])[0])
+            start = 0
+            match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+            if match and int(match.group(1)) < size:
+                start = int(match.group(1))
+            self.sendbody(bytes(size - start), 'audio/mpeg', start=start, total=size if match else None)
+        else:
+            self.send_error(404)
+
+    def sendbody(self, body, contenttype, etag=None, start=0, total=None, encoding=None):
+        if total is None:
+            self.send_response(200)
+        else:
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, total - 1, total))
+        self.send_header('Content-Type', contenttype)
+        self.send_header('Content-Length', str(len(body)))
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        bandwidth = self.server.fakehost.bandwidth
+        if bandwidth is None:
+            self.wfile.write(body)
+            return
+        # Send in tenths of a second worth of data.
+        chunk = max(1, bandwidth // 10)
+        view = memoryview(body)
+        for pos in range(0, len(body), chunk):
+            piece = view[pos:pos + chunk]
+            self.wfile.write(piece)
+            time.sleep(len(piece) / bandwidth)
+
+    def log_message(self, fmt, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', default=8000, type=int, help='listen port. Default: %(default)s')
+    parser.add_argument('--latency', default=0, type=float, metavar='SECONDS', help='delay before each response. Default: %(default)s')
+    parser.add_argument('--bandwidth', default=None, type=int, metavar='BYTES', help='per response transfer rate in bytes/s. Default: unlimited')
+    parser.add_argument('--mediasize', default=0x10000, type=int, metavar='BYTES', help='size of media files. Default: %(default)s')
+    parser.add_argument('--nocompress', default=False, action='store_true', help="don't gzip feeds")
+    args = parser.parse_args()
+    host = FakeHost(port=args.port, latency=args.latency, bandwidth=args.bandwidth, mediasize=args.mediasize, compress=not args.nocompress)
+    print('Serving on {}, eg {}'.format(host.url, host.feedurl('example', 100)))
+    try:
+        host.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
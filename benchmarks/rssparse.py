@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+"""
+Rss parser benchmark: checks that the rssxml parser backends agree on a corpus of real-world feed quirks, then times
+them on a large synthetic feed.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+$ python3 benchmarks/rssparse.py --items 5000 --output rssparse.json
+
+The corpus check, from tests/rsscorpus.py, is the same one the tests run. The exit status is 1 if any backend's
+episodes, channel or schedule hints differ from those of the etree backend.
+"""
+import argparse
+import datetime
+import email.utils
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import time
+import xml.sax.saxutils as su
+
+import commands
+
+sys.path.insert(0, commands.repodir)
+sys.path.insert(0, os.path.join(commands.repodir, 'tests'))
+from scoop import rssxml
+from rsscorpus import checkcorpus
+
+def makefeed(items):
+    """ Return rss bytes for a podcast of items episodes, with the itunes and content extras of a typical feed. """
+    esc = su.escape
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>\n'
+             '<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd" xmlns:content="http://purl.org/rss/1.0/modules/content/" xmlns:atom="http://www.w3.org/2005/Atom">\n'
+             '<channel>\n<title>Benchmark</title>\n<link>http://example.com/</link>\n<description>A synthetic podcast.</description>\n'
+             '<atom:link href="http://example.com/feed.rss" rel="self" type="application/rss+xml"/>\n'
+             '<itunes:author>Scoop</itunes:author>\n<itunes:image href="http://example.com/cover.jpg"/>\n<ttl>60</ttl>\n']
+    notes = ' '.join(['Show notes for the episode, with <a href="http://example.com/">links</a> and the odd <em>emphasis</em>.'] * 8)
+    for i in range(items, 0, -1):
+        parts.append('<item>\n'
+                     '  <title>Episode {i}: a title of typical length</title>\n'
+                     '  <itunes:title>A title of typical length</itunes:title>\n'
+                     '  <description>{description}</description>\n'
+                     '  <content:encoded><![CDATA[<p>{notes}</p>]]></content:encoded>\n'
+                     '  <link>http://example.com/episodes/{i}</link>\n'
+                     '  <guid isPermaLink="false">benchmark-{i}</guid>\n'
+                     '  <pubDate>{pubdate}</pubDate>\n'
+                     '  <itunes:duration>01:02:{s:02}</itunes:duration>\n'
+                     '  <itunes:episode>{i}</itunes:episode>\n'
+                     '  <itunes:explicit>false</itunes:explicit>\n'
+                     '  <itunes:image href="http://example.com/episodes/{i}.jpg"/>\n'
+                     '  <enclosure url="http://example.com/media/{i}.mp3?source=feed&amp;n={i}" length="{length}" type="audio/mpeg"/>\n'
+                     '</item>\n'.format(i=i, s=i % 60, description=esc(notes), notes=notes,
+                                        pubdate=email.utils.formatdate(1500000000 + i * 86400, usegmt=True), length=1000000 + i))
+    parts.append('</channel>\n</rss>\n')
+    return ''.join(parts).encode('utf-8')
+
+def timebackend(rssxmlbytes, backend):
+    start = time.perf_counter()
+    episodes = list(rssxml.RssStream(rssxml.chunked(rssxmlbytes), backend=backend).episodes())
+    return time.perf_counter() - start, len(episodes)
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--items', default=5000, type=int, help='synthetic feed size, in episodes. Default: %(default)s')
+    parser.add_argument('--repeat', default=5, type=int, help='runs of each backend. Default: %(default)s')
+    parser.add_argument('--verbose', default=False, action='store_true', help='print what the reference backend reads from each corpus feed')
+    parser.add_argument('--output', default=None, metavar='FILE', help='write JSON results to FILE. Default: stdout')
+    args = parser.parse_args()
+    backends = sorted(rssxml.backends)
+    corpus = checkcorpus(backends, args.verbose)
+    for name, diffs in corpus.items():
+        print('{:20} {}'.format(name, 'ok' if not diffs else '{} differences'.format(len(diffs))), file=sys.stderr)
+        for d in diffs:
+            print('    ' + d, file=sys.stderr)
+    rssxmlbytes = makefeed(args.items)
+    results = []
+    for backend in backends:
+        runs = [timebackend(rssxmlbytes, backend) for _ in range(args.repeat)]
+        times = [t for t, _ in runs]
+        results.append(dict(backend=backend, episodes=runs[0][1], runs=times, best=min(times), median=statistics.median(times)))
+        print('{:8} {:8.1f}ms {:8.1f}ms median {:10.1f} episodes/s'.format(backend, min(times) * 1000, statistics.median(times) * 1000, runs[0][1] / min(times)), file=sys.stderr)
+    report = dict(commit=commands.gitcommit(), date=datetime.datetime.now().isoformat(timespec='seconds'), python=sys.version.split()[0], sqlite=sqlite3.sqlite_version,
+                  default=rssxml.defaultbackend, items=args.items, bytes=len(rssxmlbytes), corpus=corpus, results=results)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if any(corpus.values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#! /usr/bin/env python3
+"""
+Startup benchmark: times quick scoop commands, whose run time is mostly interpreter start, imports and opening the db.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+$ python3 benchmarks/startup.py --repeat 20 --output startup.json
+
+Read only commands should finish within --target milliseconds. The exit status is 1 if any of them don't.
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import commands
+import dbqueries
+
+# name, scoop arguments, read only.
+benchcommands = [
+    ('help', ['--help'], True),
+    ('config', ['config'], True),
+    ('config get', ['config', 'get', 'downloaddir'], True),
+    ('podcast ls', ['podcast', 'ls'], True),
+    ('episode ls', ['episode', 'ls', 'episode 7 of podcast 3'], True),
+    ('dl ls', ['dl', 'ls', '--waiting'], True),
+    ('config set', ['config', 'set', 'busytimeout', '30'], False),
+]
+
+def timecommand(dbfile, args):
+    env = dict(os.environ, PYTHONPATH=commands.repodir)
+    start = time.perf_counter()
+    subprocess.run([sys.executable, commands.scoopbin, '--dbfile', dbfile] + args, env=env, check=True, stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+def timeinterpreter():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'pass'], check=True)
+    return time.perf_counter() - start
+
+def scoopmodules(args):
+    """ Return the scoop modules imported by a run of args, as reported by a fresh interpreter. """
+    code = '\n'.join(['import json, sys', 'import scoop.scoopcli', 'sys.argv = ["scoop"] + json.loads(sys.argv[1])',
+                       'try:', '    scoop.scoopcli.main()', 'except SystemExit:', '    pass',
+                       'print(json.dumps(sorted(m for m in sys.modules if m.startswith("scoop."))), file=sys.stderr)'])
+    env = dict(os.environ, PYTHONPATH=commands.repodir)
+    proc = subprocess.run([sys.executable, '-c', code, json.dumps(args)], env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    return json.loads(proc.stderr.splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--episodes', default=1000, type=int, help='library size, in episodes. Default: %(default)s')
+    parser.add_argument('--repeat', default=10, type=int, help='runs of each command. Default: %(default)s')
+    parser.add_argument('--target', default=50, type=float, metavar='MS', help='read only command target in milliseconds. Default: %(default)s')
+    parser.add_argument('--output', default=None, metavar='FILE', help='write JSON results to FILE. Default: stdout')
+    args = parser.parse_args()
+    workdir = tempfile.mkdtemp()
+    try:
+        dbfile = os.path.join(workdir, 'scoop.db')
+        dbqueries.makelibrary(dbfile, max(1, args.episodes // 200), args.episodes).conn.close()
+        # Compile the modules before timing.
+        timecommand(dbfile, ['config'])
+        interpreter = min(timeinterpreter() for _ in range(args.repeat))
+        print('{:12} {:8.1f}ms'.format('python', interpreter * 1000), file=sys.stderr)
+        results = []
+        slow = []
+        for name, cmdargs, readonly in benchcommands:
+            runs = [timecommand(dbfile, cmdargs) for _ in range(args.repeat)]
+            best = min(runs)
+            if readonly and best * 1000 > args.target:
+                slow.append(name)
+            modules = scoopmodules(['--dbfile', dbfile] + cmdargs)
+            results.append(dict(command=name, args=cmdargs, readonly=readonly, runs=runs, best=best, median=statistics.median(runs), modules=modules))
+            print('{:12} {:8.1f}ms {:8.1f}ms median  {}'.format(name, best * 1000, statistics.median(runs) * 1000, ' '.join(modules)), file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir)
+    report = dict(commit=commands.gitcommit(), date=datetime.datetime.now().isoformat(timespec='seconds'), python=sys.version.split()[0], sqlite=sqlite3.sqlite_version, episodes=args.episodes, target=args.target / 1000, interpreter=interpreter, results=results)
+    if args.output is None:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if slow:
+        print('Slower than {}ms: {}'.format(args.target, ', '.join(slow)), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
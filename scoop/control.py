@@ -0,0 +1,56 @@
+"""
+Client side of the scoop daemon's control socket.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+The protocol is JSON, one message per line. The client sends the command line to run and its working directory:
+    {"argv": ["dl", "ls"], "cwd": "/home/me"}
+The daemon runs it and replies with its output, then the exit status:
+    {"out": "..."} {"err": "..."} ... {"exit": 0}
+"""
+import json
+import os
+import socket
+import sys
+
+def sendmessage(sock, **message):
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+def readmessages(sock):
+    """ Yield messages from sock until it closes. """
+    with sock.makefile('rb') as f:
+        for line in f:
+            yield json.loads(line)
+
+def connect(path):
+    """ Return a socket connected to the daemon at path, or None if no daemon is running. """
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        # Left behind by a daemon that didn't shut down cleanly, or not a socket at all.
+        sock.close()
+        return None
+    return sock
+
+def forward(path, argv, cwd):
+    """ Run argv in the daemon at path, printing its output. Returns the exit status, or None if no daemon is
+    running. """
+    sock = connect(path)
+    if sock is None:
+        return None
+    with sock:
+        sendmessage(sock, argv=argv, cwd=cwd)
+        for message in readmessages(sock):
+            # Flush each piece so that output and errors stay in order.
+            if 'out' in message:
+                sys.stdout.write(message['out'])
+                sys.stdout.flush()
+            elif 'err' in message:
+                sys.stderr.write(message['err'])
+                sys.stderr.flush()
+            elif 'exit' in message:
+                return message['exit']
+    print('scoop daemon closed the connection', file=sys.stderr)
+    return 1
@@ -0,0 +1,270 @@
+"""
+Scoop daemon: keeps the db and HTTP connections open, syncs feeds as they fall due and downloads new episodes, and
+runs commands sent by the scoop cli over a unix control socket.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+Commands that use the network, podcast add and the syncs, run one at a time on the sync thread along with scheduled
+syncs. Other commands run straight away on the main thread, which serves the socket. Each thread has its own db
+connection.
+"""
+import contextlib
+import json
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from . import control
+from . import db
+from . import playlist
+from . import scoop
+from . import scoopcli
+from . import sql
+
+# Least time in seconds between scheduled syncs, so that a feed that fails to sync isn't retried in a tight loop.
+minwait = 60
+
+# Sync thread requests, besides (args, client) commands.
+DOWNLOADS = 'downloads'
+STOP = 'stop'
+
+class OutputRouter:
+    """ Stands in for sys.stdout or sys.stderr. Each thread's output goes to the stream it has redirected to, or to the
+    original stream. """
+
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+
+    @contextlib.contextmanager
+    def redirect(self, stream):
+        self.local.stream = stream
+        try:
+            yield
+        finally:
+            self.local.stream = None
+
+    def write(self, text):
+        return (getattr(self.local, 'stream', None) or self.default).write(text)
+
+    def flush(self):
+        (getattr(self.local, 'stream', None) or self.default).flush()
+
+    def __getattr__(self, name):
+        return getattr(self.default, name)
+
+class Client:
+    """ A cli connection. Output is sent back as it is written. If the client goes away, output is dropped and the
+    command carries on. """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.alive = True
+        self.stdout = ClientStream(self, 'out')
+        self.stderr = ClientStream(self, 'err')
+
+    def send(self, **message):
+        if self.alive:
+            try:
+                control.sendmessage(self.sock, **message)
+            except OSError:
+                self.alive = False
+
+    def finish(self, status):
+        self.send(exit=status)
+        self.sock.close()
+
+class ClientStream:
+
+    def __init__(self, client, kind):
+        self.client = client
+        self.kind = kind
+
+    def write(self, text):
+        if text:
+            self.client.send(**{self.kind: text})
+        return len(text)
+
+    def flush(self):
+        pass
+
+@contextlib.contextmanager
+def redirected(client):
+    """ Send the calling thread's output to client. sys.stdout and sys.stderr are OutputRouters while serving. """
+    with sys.stdout.redirect(client.stdout), sys.stderr.redirect(client.stderr):
+        yield
+
+def exitstatus(e):
+    """ Return the exit status of SystemExit e. """
+    if e.code is None or isinstance(e.code, int):
+        return e.code or 0
+    print(e.code, file=sys.stderr)
+    return 1
+
+def runcommand(args, client):
+    """ Run a parsed cli command, with output going to client. """
+    with redirected(client):
+        try:
+            args.command(args)
+            status = 0
+        except SystemExit as e:
+            status = exitstatus(e)
+        except Exception:
+            traceback.print_exc()
+            status = 1
+    client.finish(status)
+
+class Syncer(threading.Thread):
+    """ Runs scheduled syncs, and network commands sent by clients, one at a time.
+    Feeds are synced when the first of them falls due, or every interval seconds at most. New episodes are downloaded
+    after each feed sync, and also when a client queues downloads. """
+
+    def __init__(self, dbfile, interval, jobs, hostjobs, updateindex, listgen):
+        super().__init__(name='sync')
+        self.dbfile = dbfile
+        self.interval = interval
+        self.jobs = jobs
+        self.hostjobs = hostjobs
+        self.updateindex = updateindex
+        self.listgen = listgen
+        self.requests = queue.Queue()
+
+    def stop(self):
+        """ Stop once the current sync or command is done. """
+        self.requests.put(STOP)
+
+    def run(self):
+        dbobj = db.DB(self.dbfile)
+        pool = scoop.newpool(sql.loadconfig(dbobj), maxidle=self.hostjobs)
+        try:
+            nextrun = time.time()
+            while True:
+                try:
+                    request = self.requests.get(timeout=max(0, nextrun - time.time()))
+                except queue.Empty:
+                    request = None
+                if request == STOP:
+                    break
+                # Config may have been changed through the main thread's connection.
+                dbobj.config = None
+                if request is None:
+                    nextrun = self.syncall(dbobj, pool)
+                elif request == DOWNLOADS:
+                    self.guard(self.downloads, dbobj, pool)
+                else:
+                    args, client = request
+                    args.dbobj = dbobj
+                    args.pool = pool
+                    runcommand(args, client)
+        finally:
+            pool.close()
+
+    def guard(self, func, *args, **kwargs):
+        """ Call func, logging rather than raising any error. Returns True if func succeeded. """
+        try:
+            func(*args, **kwargs)
+        except Exception:
+            traceback.print_exc()
+            return False
+        return True
+
+    def syncall(self, dbobj, pool):
+        """ Sync the feeds that are due and download new episodes. Returns when to sync next. """
+        print('{}: syncing feeds'.format(time.strftime('%Y-%m-%d %H:%M:%S')))
+        synced = self.guard(scoop.syncpodcasts, dbobj, jobs=self.jobs, hostjobs=self.hostjobs, pool=pool)
+        self.guard(self.downloads, dbobj, pool)
+        now = time.time()
+        nextrun = now + self.interval
+        nextcheck = sql.getnextcheck(dbobj)
+        if synced and nextcheck is not None:
+            nextrun = min(nextrun, nextcheck)
+        return max(nextrun, now + minwait)
+
+    def downloads(self, dbobj, pool):
+        dls = scoop.syncdls(dbobj, updateindex=self.updateindex, jobs=self.jobs, hostjobs=self.hostjobs, pool=pool)
+        if dls and self.listgen:
+            specs = [s._replace(newerthan=scoopcli.daystotimestamp(s.newerthan)) for s in playlist.getsavedspecs(dbobj)]
+            playlist.makeplaylists(dbobj, specs)
+
+def handle(sock, dbobj, syncer):
+    """ Read a command from a client connection and run it, or pass it to the sync thread. """
+    client = Client(sock)
+    try:
+        # Don't let a stalled client hold up the socket.
+        sock.settimeout(10)
+        with sock.makefile('rb') as f:
+            message = json.loads(f.readline())
+        sock.settimeout(None)
+        argv = message['argv']
+        cwd = message['cwd']
+    except (OSError, ValueError, KeyError, TypeError):
+        sock.close()
+        return
+    with redirected(client):
+        try:
+            args = scoopcli.makeparser(argv).parse_args(argv)
+        except SystemExit as e:
+            status = exitstatus(e)
+            args = None
+    if args is None:
+        client.finish(status)
+        return
+    args.cwd = cwd
+    if args.network:
+        syncer.requests.put((args, client))
+        return
+    args.dbobj = dbobj
+    runcommand(args, client)
+    if args.enqueues:
+        syncer.requests.put(DOWNLOADS)
+
+def serve(dbfile, interval=3600, jobs=4, hostjobs=2, updateindex=False, listgen=False):
+    """ Run the daemon for dbfile until interrupted or sent SIGTERM. Returns the exit status. """
+    path = scoopcli.socketpath(dbfile)
+    running = control.connect(path)
+    if running is not None:
+        running.close()
+        print('scoop daemon is already running: {}'.format(path), file=sys.stderr)
+        return 1
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(path)
+    dbobj = db.DB(dbfile)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the owner may connect.
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen()
+    # Wake up regularly to notice SIGTERM.
+    server.settimeout(1)
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = OutputRouter(stdout), OutputRouter(stderr)
+    syncer = Syncer(dbfile, interval, jobs, hostjobs, updateindex, listgen)
+    syncer.start()
+    print('scoop daemon listening on {}'.format(path))
+    try:
+        while not stopping.is_set():
+            try:
+                sock, _ = server.accept()
+            except socket.timeout:
+                continue
+            handle(sock, dbobj, syncer)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(path)
+        print('scoop daemon stopping')
+        syncer.stop()
+        syncer.join()
+        sys.stdout, sys.stderr = stdout, stderr
+        dbobj.optimize()
+    return 0
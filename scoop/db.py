@@ -5,24 +5,184 @@ Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
 import os
 import sqlite3
 
+# Current schema version, as created by schema.sqlite.
+schemaversion = 16
+
+# Seconds to wait for another process's lock if the busytimeout config value is unusable.
+defaultbusytimeout = 30
+
+# Upgrade scripts, keyed by the schema version that they upgrade from.
+migrations = {
+    2: '''
+ALTER TABLE podcast ADD COLUMN stopped INTEGER;
+''',
+    3: '''
+ALTER TABLE podcast ADD COLUMN etag TEXT;
+ALTER TABLE podcast ADD COLUMN lastmodified TEXT;
+''',
+    4: '''
+ALTER TABLE podcast ADD COLUMN rssdigest TEXT;
+''',
+    5: '''
+CREATE INDEX episode_podcastid_pubdate ON episode (podcastid, pubdate);
+CREATE INDEX dl_episodeid_status ON dl (episodeid, status);
+CREATE INDEX dl_status_actioned ON dl (status, actioned);
+ANALYZE;
+''',
+    6: '''
+CREATE VIRTUAL TABLE podcastfts USING fts5(title, content='podcast', content_rowid='podcastid');
+CREATE TRIGGER podcast_ai AFTER INSERT ON podcast BEGIN
+	INSERT INTO podcastfts (rowid, title) VALUES (new.podcastid, new.title);
+END;
+CREATE TRIGGER podcast_ad AFTER DELETE ON podcast BEGIN
+	INSERT INTO podcastfts (podcastfts, rowid, title) VALUES ('delete', old.podcastid, old.title);
+END;
+CREATE TRIGGER podcast_au AFTER UPDATE OF title ON podcast BEGIN
+	INSERT INTO podcastfts (podcastfts, rowid, title) VALUES ('delete', old.podcastid, old.title);
+	INSERT INTO podcastfts (rowid, title) VALUES (new.podcastid, new.title);
+END;
+CREATE VIRTUAL TABLE episodefts USING fts5(title, description, content='episode', content_rowid='episodeid');
+CREATE TRIGGER episode_ai AFTER INSERT ON episode BEGIN
+	INSERT INTO episodefts (rowid, title, description) VALUES (new.episodeid, new.title, new.description);
+END;
+CREATE TRIGGER episode_ad AFTER DELETE ON episode BEGIN
+	INSERT INTO episodefts (episodefts, rowid, title, description) VALUES ('delete', old.episodeid, old.title, old.description);
+END;
+CREATE TRIGGER episode_au AFTER UPDATE OF title, description ON episode BEGIN
+	INSERT INTO episodefts (episodefts, rowid, title, description) VALUES ('delete', old.episodeid, old.title, old.description);
+	INSERT INTO episodefts (rowid, title, description) VALUES (new.episodeid, new.title, new.description);
+END;
+INSERT INTO podcastfts (podcastfts) VALUES ('rebuild');
+INSERT INTO episodefts (episodefts) VALUES ('rebuild');
+''',
+    7: '''
+ALTER TABLE dl ADD COLUMN leaseowner TEXT;
+ALTER TABLE dl ADD COLUMN leaseexpires INTEGER;
+INSERT INTO config ('key', 'value', 'description') VALUES ('busytimeout', '30', 'Seconds to wait for another scoop to release the database');
+INSERT INTO config ('key', 'value', 'description') VALUES ('leasetime', '900', 'Seconds a dl sync holds a download before other syncs may take it over');
+''',
+    8: '''
+-- Playlists written by scoop, so that updates can add only new entries.
+CREATE TABLE playlist (
+	playlistid	INTEGER PRIMARY KEY,
+	filename	TEXT UNIQUE,	-- full path of the m3u file.
+	mtime		INTEGER,	-- file modification time (ns) when scoop last wrote it.
+	size		INTEGER		-- file size when scoop last wrote it.
+);
+
+-- Download orders written to each playlist.
+CREATE TABLE playlistentry (
+	playlistid	INTEGER REFERENCES playlist ON DELETE CASCADE,
+	dlid		INTEGER REFERENCES dl,
+	PRIMARY KEY (playlistid, dlid)
+) WITHOUT ROWID;
+''',
+    9: '''
+-- Playlists generated by a plain 'scoop listgen'.
+CREATE TABLE listspec (
+	filename	TEXT PRIMARY KEY,	-- full path of the m3u file.
+	podcast		TEXT,			-- podcast title search string.
+	episode		TEXT,			-- episode title search string.
+	newerthan	INTEGER			-- only episodes downloaded within this many days.
+);
+''',
+    10: '''
+ALTER TABLE podcast ADD COLUMN lastchecked INTEGER;
+ALTER TABLE podcast ADD COLUMN lastchanged INTEGER;
+ALTER TABLE podcast ADD COLUMN nextcheck INTEGER;
+ALTER TABLE podcast ADD COLUMN ttl INTEGER;
+ALTER TABLE podcast ADD COLUMN skiphours TEXT;
+ALTER TABLE podcast ADD COLUMN skipdays TEXT;
+INSERT INTO config ('key', 'value', 'description') VALUES ('minpoll', '3600', 'Shortest time in seconds between checks of a podcast rss');
+INSERT INTO config ('key', 'value', 'description') VALUES ('maxpoll', '604800', 'Longest time in seconds between checks of a podcast rss');
+''',
+    11: '''
+ALTER TABLE podcast ADD COLUMN priority INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE dl ADD COLUMN priority INTEGER;
+ALTER TABLE dl ADD COLUMN size INTEGER;
+INSERT INTO config ('key', 'value', 'description') VALUES ('dlbudget', '0', 'MiB that dl sync may download in each download window, 0 for no limit');
+INSERT INTO config ('key', 'value', 'description') VALUES ('dlwindow', '', 'Times of day that dl sync downloads, eg 01:00-06:00,22:00-23:30. Empty for any time');
+INSERT INTO config ('key', 'value', 'description') VALUES ('urgentpriority', '10', 'Orders of this priority or higher download at any time, outside dlwindow and dlbudget');
+''',
+    12: '''
+ALTER TABLE dl ADD COLUMN sha256 TEXT;
+CREATE INDEX dl_sha256 ON dl (sha256) WHERE sha256 IS NOT NULL;
+''',
+    13: '''
+INSERT INTO config ('key', 'value', 'description') VALUES ('fsync', 'never', 'When downloads are flushed to disk: never, file once each is complete, or a number of MiB to also flush every that many MiB');
+''',
+    14: '''
+ALTER TABLE dl ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0;
+''',
+    15: '''
+ALTER TABLE podcast ADD COLUMN failures INTEGER NOT NULL DEFAULT 0;
+''',
+    }
+
 class DB:
 
     def __init__(self, dbfile):
         self.filename = dbfile
         self._cursors = []
-        if dbfile == ':memory:' or not os.path.exists(dbfile):
-            self._createandloaddb()
-        else:
-            self._loaddb()
+        # Cached sql.Config.
+        self.config = None
+        self._conn = None
+
+    @property
+    def conn(self):
+        """ The db connection, opened on first use so that commands which never query the db don't open it.
+        A missing db is created and an old one upgraded as it is opened. """
+        if self._conn is None:
+            if self.filename == ':memory:' or not os.path.exists(self.filename):
+                self._createandloaddb()
+            else:
+                self._loaddb()
+        return self._conn
+
+    def _connect(self):
+        self._conn = sqlite3.connect(self.filename)
+        self._conn.execute('PRAGMA foreign_keys=ON')
+        # Write ahead logging lets readers carry on while another scoop process writes.
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.row_factory = sqlite3.Row
 
     def _loaddb(self):
-        self.conn = sqlite3.connect(self.filename)
-        self.conn.execute('PRAGMA foreign_keys=ON')
-        self.conn.row_factory = sqlite3.Row
+        self._connect()
+        self._migrate()
+        self._setbusytimeout()
+
+    def _setbusytimeout(self):
+        """ Wait up to config.busytimeout seconds for another process's lock, rather than failing with 'database is locked'. """
+        with self as conn:
+            value = conn.execute("SELECT value FROM config WHERE key = 'busytimeout'").fetchone()[0]
+        # A bad value mustn't stop the db from opening, or it could never be set right.
+        try:
+            seconds = int(value)
+        except (TypeError, ValueError):
+            seconds = defaultbusytimeout
+        self.conn.execute('PRAGMA busy_timeout={}'.format(seconds * 1000))
+
+    def _getschemaversion(self):
+        with self as conn:
+            return int(conn.execute("SELECT value FROM config WHERE key = 'schemaversion'").fetchone()[0])
+
+    def _migrate(self):
+        """ Upgrade the db in place, one schema version at a time. Each upgrade is its own transaction. """
+        version = self._getschemaversion()
+        while version < schemaversion:
+            with self as conn:
+                try:
+                    conn.executescript('BEGIN;' + migrations[version] + "UPDATE config SET value = '{}' WHERE key = 'schemaversion'; COMMIT;".format(version + 1))
+                except sqlite3.Error:
+                    self.rollback()
+                    raise
+            version += 1
 
     def _loadschema(self):
+        """ Return the schema script. Only read when creating a db. """
         schemafile = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'schema.sqlite')
-        return open(schemafile).read()
+        with open(schemafile) as f:
+            return f.read()
 
     def _createandloaddb(self):
         """ Create the db: load in the schema and populate with default config. """
@@ -30,10 +190,11 @@ class DB:
         # basedir will return '' if self.filename is in the current directory.
         if basedir != '':
             os.makedirs(basedir, exist_ok=True)
-        self._loaddb()
+        self._connect()
         with self as conn:
             conn.executescript(self._loadschema())
             self.commit()
+        self._setbusytimeout()
 
     def __enter__(self):
         c = self.conn.cursor()
@@ -43,6 +204,19 @@ class DB:
     def __exit__(self, exc_type, exc_val, exc_tb):
         c = self._cursors.pop()
         c.close()
+        if exc_type is not None and self._conn is not None and self._conn.in_transaction:
+            # Don't leave a failed write holding the lock, other scoops would wait on it until busytimeout.
+            self.rollback()
+
+    def optimize(self):
+        """ Refresh query planner statistics if needed. SQLite recommends this before closing a connection. """
+        if self._conn is not None:
+            self._conn.execute('PRAGMA optimize')
+
+    def begin(self):
+        """ Start a write transaction now, rather than at the first change, so that reads made within it stay valid. """
+        if not self.conn.in_transaction:
+            self.conn.execute('BEGIN IMMEDIATE')
 
     def commit(self):
         self.conn.commit()
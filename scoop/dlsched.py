@@ -0,0 +1,42 @@
+"""
+Download queue scheduling: which waiting download orders dl sync may take, and when.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+Waiting orders are taken highest priority first, then newest episode first. An order's priority is its own if set,
+otherwise its podcast's. Downloads can be kept to the times of day in the dlwindow config setting, eg off-peak hours,
+and to dlbudget MiB in each window. Orders of urgentpriority or higher are taken at any time, and don't count towards
+the budget.
+"""
+import time
+
+from . import sql
+
+def windowstart(windows, now):
+    """ Return when the download window that now is in opened, or None if now is outside every window.
+    windows are (start, end) minutes after local midnight, a window ending before it starts runs past midnight.
+    With no windows, the whole day is one window. """
+    tm = time.localtime(now)
+    def at(days, minutes):
+        # mktime normalises out of range days and minutes.
+        return int(time.mktime((tm.tm_year, tm.tm_mon, tm.tm_mday + days, 0, minutes, 0, 0, 0, -1)))
+    if not windows:
+        return at(0, 0)
+    minute = tm.tm_hour * 60 + tm.tm_min
+    for start, end in windows:
+        if start < end:
+            if start <= minute < end:
+                return at(0, start)
+        elif minute >= start:
+            return at(0, start)
+        elif minute < end:
+            return at(-1, start)
+    return None
+
+def minpriority(db, config, now):
+    """ Return the lowest priority of the orders that may be downloaded now, None if any order may be. """
+    opened = windowstart(config.dlwindow, now)
+    if opened is None:
+        return config.urgentpriority
+    if config.dlbudget and sql.getdlbytes(db, opened, config.urgentpriority) >= config.dlbudget * 0x100000:
+        return config.urgentpriority
+    return None
@@ -0,0 +1,269 @@
+"""
+Keep-alive HTTP connection pool.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+Requests to hosts that the environment's http_proxy and https_proxy settings send through a proxy are made with
+urllib instead, without keep-alive.
+"""
+import collections
+import http.client
+import threading
+import time
+import urllib.error as ue
+import urllib.parse as up
+import urllib.request as ur
+import zlib
+
+redirectcodes = frozenset([301, 302, 303, 307, 308])
+defaultports = {'http': 80, 'https': 443}
+
+# Accept-Encoding for requests whose bodies Decoder can read.
+acceptencoding = 'gzip, deflate'
+
+class Pool:
+    """ HTTP client that reuses connections, keyed by scheme, host and port. May be shared between threads. """
+
+    def __init__(self, agent, maxidle=4, maxredirects=10, timeout=60):
+        self.agent = agent
+        self.maxidle = maxidle
+        self.maxredirects = maxredirects
+        self.timeout = timeout
+        # Counts of 'requests', 'connections' opened, 'reused' connections and 'redirects' followed.
+        self.stats = collections.Counter()
+        # Seconds spent opening connections ('connect', includes DNS lookup) and waiting for response headers ('response').
+        self.times = collections.Counter()
+        # Proxies by scheme, from the environment.
+        self.proxies = ur.getproxies()
+        self._idle = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    def resetstats(self):
+        """ Zero stats and times, eg so that a pool kept open reports each sync's requests on their own. """
+        with self._lock:
+            self.stats.clear()
+            self.times.clear()
+
+    def open(self, url, headers={}):
+        """ GET url, following redirects. Returns a Response whose url is the final url.
+        Raises urllib.error.HTTPError for non 2xx responses, same as urllib.request.urlopen. """
+        for _ in range(self.maxredirects + 1):
+            if self._proxied(url):
+                # urllib follows any further redirects itself.
+                return self._openproxied(url, headers)
+            resp = self._request(url, headers)
+            if resp.status not in redirectcodes or 'Location' not in resp.headers:
+                break
+            resp.close()
+            url = up.urljoin(url, resp.headers['Location'])
+            self._count('redirects')
+        else:
+            raise ue.HTTPError(url, resp.status, 'Too many redirects', resp.headers, None)
+        if not 200 <= resp.status < 300:
+            resp.close()
+            raise ue.HTTPError(url, resp.status, resp.reason, resp.headers, None)
+        return resp
+
+    def close(self):
+        """ Close all idle connections. """
+        with self._lock:
+            idle = [c for conns in self._idle.values() for c in conns]
+            self._idle.clear()
+        for conn in idle:
+            conn.close()
+
+    def _proxied(self, url):
+        """ Return True if url is to be fetched through a proxy. Raises ValueError for urls that aren't http or https. """
+        parts = up.urlsplit(url)
+        if parts.scheme not in defaultports:
+            raise ValueError('Unsupported url, only http and https are supported: {}'.format(url))
+        return parts.scheme in self.proxies and not ur.proxy_bypass(parts.hostname or '')
+
+    def _openproxied(self, url, headers):
+        """ GET url through the proxy with urllib, which also raises HTTPError for non 2xx responses. """
+        req = ur.Request(url, headers=dict(headers, **{'User-Agent': self.agent}))
+        self._count('requests')
+        start = time.perf_counter()
+        try:
+            return ur.urlopen(req, timeout=self.timeout)
+        finally:
+            self._addtime('response', time.perf_counter() - start)
+
+    def _request(self, url, headers):
+        parts = up.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port or defaultports[parts.scheme])
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        reqheaders = dict(headers, **{'User-Agent': self.agent})
+        conn = self._take(key)
+        reused = conn is not None
+        if conn is None:
+            conn = self._connect(key)
+        start = time.perf_counter()
+        try:
+            conn.request('GET', path, headers=reqheaders)
+            resp = conn.getresponse()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # The server dropped the idle connection, retry once on a new one.
+            conn = self._connect(key)
+            start = time.perf_counter()
+            conn.request('GET', path, headers=reqheaders)
+            resp = conn.getresponse()
+        self._count('requests')
+        self._addtime('response', time.perf_counter() - start)
+        return Response(self, key, conn, resp, url)
+
+    def _connect(self, key):
+        scheme, host, port = key
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        self._count('connections')
+        conn = cls(host, port, timeout=self.timeout)
+        start = time.perf_counter()
+        try:
+            conn.connect()
+        finally:
+            self._addtime('connect', time.perf_counter() - start)
+        return conn
+
+    def _take(self, key):
+        with self._lock:
+            try:
+                conn = self._idle[key].pop()
+            except IndexError:
+                return None
+            self.stats['reused'] += 1
+            return conn
+
+    def _release(self, key, conn):
+        with self._lock:
+            if len(self._idle[key]) < self.maxidle:
+                self._idle[key].append(conn)
+                return
+        conn.close()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _addtime(self, name, seconds):
+        with self._lock:
+            self.times[name] += seconds
+
+class Decoder:
+    """ Iterates over chunks of a response body, undoing its Content-Encoding as they arrive. wirebytes and size count the
+    bytes received and decoded. keepgzip holds on to a gzip encoded body, in gzip, for callers that want to store it
+    compressed. """
+
+    # Most bytes decoded at a time.
+    chunksize = 0x10000
+
+    def __init__(self, chunks, encoding=None, keepgzip=False):
+        self.chunks = chunks
+        self.encoding = (encoding or 'identity').strip().lower()
+        if self.encoding == 'x-gzip':
+            self.encoding = 'gzip'
+        if self.encoding not in ('identity', 'gzip', 'deflate'):
+            raise http.client.HTTPException('Unsupported Content-Encoding: {}'.format(encoding))
+        self.gzipchunks = [] if keepgzip and self.encoding == 'gzip' else None
+        self.wirebytes = 0
+        self.size = 0
+
+    @property
+    def gzipbytes(self):
+        """ The body as received, if it was gzip encoded and keepgzip was set, otherwise None. """
+        return None if self.gzipchunks is None else b''.join(self.gzipchunks)
+
+    def _decompressor(self):
+        if self.encoding == 'gzip':
+            return zlib.decompressobj(16 + zlib.MAX_WBITS)
+        return zlib.decompressobj()
+
+    def __iter__(self):
+        if self.encoding == 'identity':
+            for chunk in self.chunks:
+                self.wirebytes += len(chunk)
+                self.size += len(chunk)
+                yield chunk
+            return
+        d = self._decompressor()
+        first = True
+        for chunk in self.chunks:
+            self.wirebytes += len(chunk)
+            if self.gzipchunks is not None:
+                self.gzipchunks.append(chunk)
+            if first and self.encoding == 'deflate':
+                try:
+                    zlib.decompressobj().decompress(chunk[:2])
+                except zlib.error:
+                    # Plenty of servers send deflate without the zlib header.
+                    d = zlib.decompressobj(-zlib.MAX_WBITS)
+            first = False
+            # Output is limited to chunksize at a time, so that a reader that stops early doesn't pay to inflate the
+            # rest of a highly compressed chunk.
+            while chunk:
+                data = d.decompress(chunk, self.chunksize)
+                chunk = d.unconsumed_tail
+                if d.eof and d.unused_data:
+                    # gzip bodies may hold several members, one after the other.
+                    chunk = d.unused_data
+                    d = self._decompressor()
+                if data:
+                    self.size += len(data)
+                    yield data
+        data = d.flush()
+        if data:
+            self.size += len(data)
+            yield data
+
+class Response:
+    """ A Pool response. Has the attributes of a urllib response that scoop uses.
+    Closing the response returns its connection to the pool if the body was fully read. """
+
+    # Unread bodies up to this size are read and discarded on close so the connection may be reused.
+    draincutoff = 0x10000
+
+    def __init__(self, pool, key, conn, resp, url):
+        self.url = url
+        self.status = resp.status
+        self.reason = resp.reason
+        self.headers = resp.headers
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._resp = resp
+
+    @property
+    def length(self):
+        """ Number of body bytes still to be read, None if unknown. """
+        return self._resp.length
+
+    def read(self, amt=None):
+        return self._resp.read(amt)
+
+    def readinto(self, b):
+        return self._resp.readinto(b)
+
+    def close(self):
+        if self._conn is None:
+            return
+        conn, self._conn = self._conn, None
+        resp = self._resp
+        if not resp.isclosed() and resp.length is not None and resp.length <= self.draincutoff:
+            try:
+                resp.read()
+            except (OSError, http.client.HTTPException):
+                pass
+        if resp.isclosed() and not resp.will_close:
+            self._pool._release(self._key, conn)
+        else:
+            resp.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,113 @@
+"""
+Podcast library commands that only need the db. Kept apart from the network code in scoop.py so that they start
+quickly.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+"""
+import os
+import time
+
+from . import sql
+from . import util
+
+def printpodcasts(db, title=None):
+    podcasts = sql.getpodcasts(db, title)
+    for p in podcasts:
+        print(p.title)
+
+def editpodcast(db, podtitle, title=None, rssurl=None, stopped=None, priority=None):
+    if any([title, rssurl]) or stopped is not None or priority is not None:
+        # An exact title picks its podcast even if the search would match others too.
+        podcast = sql.getpodcastbytitle(db, podtitle)
+        podcasts = sql.getpodcasts(db, podtitle) if podcast is None else [podcast]
+        # Make sure that podtitle matches only one podcast before changing anything.
+        np = len(podcasts)
+        if np == 0:
+            print('No podcasts found matching title "{}"'.format(podtitle))
+        elif np == 1:
+            sql.editpodcast(db, podcasts[0], title=title, rssurl=rssurl, stopped=stopped, priority=priority)
+            print('{}:'.format(podtitle))
+            if title:
+                print('title: {} -> {}'.format(podcasts[0].title, title))
+                config = sql.loadconfig(db)
+                try:
+                    os.rename(util.getdestdir(config, podcasts[0].title), util.getdestdir(config, title))
+                except FileNotFoundError:
+                    pass
+            if rssurl:
+                print('rssurl: {} -> {}'.format(podcasts[0].rssurl, rssurl))
+            if stopped is not None:
+                print('stopped: {} -> {}'.format(podcasts[0].stopped, stopped))
+            if priority is not None:
+                print('priority: {} -> {}'.format(podcasts[0].priority, priority))
+        else:
+            # np > 1
+            print('More than one podcast matches title "{}", please narrow your search'.format(podtitle))
+    else:
+        print('Nothing to do! Supply a new title, rssurl or priority.')
+
+def getmaxpodtitlelen(lst):
+    return len(max(lst, key=lambda x: len(x.podtitle)).podtitle)
+
+def formatdate(ts):
+    """ Return ts as a local date, or a placeholder as wide as one if ts is unknown. """
+    if ts is None:
+        return '----------'
+    return time.strftime('%Y-%m-%d', time.localtime(ts))
+
+def printepisodes(db, podcasttitle=None, episodetitle=None):
+    """ Print matching episodes as they are read from the db. The column width comes from a separate query so that
+    the episodes aren't all held in memory. """
+    maxtitle = sql.getepisodespodtitlelen(db, podcasttitle=podcasttitle, episodetitle=episodetitle)
+    fmt = '{:<5} {:' + str(maxtitle) + '} {} {}'
+    for e in sql.iterepisodes(db, podcasttitle=podcasttitle, episodetitle=episodetitle):
+        print(fmt.format(e.episodeid, e.podtitle, formatdate(e.pubdate), e.title))
+
+def makedlsprintlines(dls, maxtitle):
+    fmt = '{} {:' + str(maxtitle) + '} {}'
+    return (fmt.format(d.status, d.podtitle, d.eptitle) for d in dls)
+
+def insertdls(db, episodes, priority=None):
+    """ Insert new dl orders for each episode in episodes. """
+    if episodes:
+        dlorders = sql.adddownloads(db, episodes, limit=False, priority=priority)
+        print('\n'.join(makedlsprintlines(dlorders, getmaxpodtitlelen(dlorders))))
+
+def dlnewepisodes(db):
+    """ Adds download orders for new episodes. """
+    insertdls(db, sql.getnewepisodes(db))
+
+def dloldepisodes(db, idlist=None, podcasttitle=None, episodetitle=None, priority=None):
+    """ Create dl orders for old/existing episodes. priority is that of the new orders, None for their podcast's. """
+    episodes = sql.getepisodes(db, idlist=idlist, podcasttitle=podcasttitle, episodetitle=episodetitle)
+    # Remove episodes that already have outstanding 'w' dl orders.
+    eids = [e.episodeid for e in episodes]
+    waitingdlids = frozenset(d.episodeid for d in sql.getdls(db, episodeids=eids, statelist=['w']))
+    insertdls(db, [e for e in episodes if e.episodeid not in waitingdlids], priority)
+
+def printdls(db, podcasttitle=None, episodetitle=None, statelist=None, newerthan=None, queued=False):
+    """ Print matching orders with their effective priority. queued lists them in the order dl sync takes them. """
+    maxtitle = sql.getdlspodtitlelen(db, podcasttitle=podcasttitle, episodetitle=episodetitle, statelist=statelist, newerthan=newerthan)
+    fmt = '{} {:>3} {:' + str(maxtitle) + '} {}'
+    for d in sql.iterdls(db, podcasttitle=podcasttitle, episodetitle=episodetitle, statelist=statelist, newerthan=newerthan, queued=queued):
+        print(fmt.format(d.status, d.effectivepriority(), d.podtitle, d.eptitle))
+
+def editdls(db, podcasttitle=None, episodetitle=None, priority=None):
+    """ Set the priority of matching waiting orders, None to follow their podcast's priority. """
+    dls = sql.getdls(db, podcasttitle=podcasttitle, episodetitle=episodetitle, statelist=['w'])
+    sql.setdlpriority(db, [d.dlid for d in dls], priority)
+    if dls:
+        fmt = '{} {:>3} {:' + str(getmaxpodtitlelen(dls)) + '} {}'
+        for d in dls:
+            d.priority = priority
+            print(fmt.format(d.status, d.effectivepriority(), d.podtitle, d.eptitle))
+
+def printallconfig(db):
+    for row in sql.getallconfig(db):
+        print('{:16} {:16} {}'.format(row['key'], row['value'], row['description']))
+
+def printconfig(db, key):
+    row = sql.getconfig(db, key)
+    print('{:16} {}'.format(key, row['value']))
+
+def setconfig(db, key, value):
+    sql.setconfig(db, key, value)
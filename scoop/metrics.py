@@ -0,0 +1,141 @@
+"""
+Timings and counters for a scoop command run.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+"""
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+class Metrics:
+    """ Phase timings, counters and per item records (feeds, downloads, playlists) for one command.
+    May be shared between threads. """
+
+    def __init__(self, command):
+        self.command = command
+        self.started = time.time()
+        self.counts = collections.Counter()
+        self.phasetimes = collections.Counter()
+        self.phasecalls = collections.Counter()
+        self.items = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def addtime(self, phase, seconds, calls=1):
+        with self._lock:
+            self.phasetimes[phase] += seconds
+            self.phasecalls[phase] += calls
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Time the enclosed block as part of phase name. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.addtime(name, time.perf_counter() - start)
+
+    @contextlib.contextmanager
+    def work(self, kind, name):
+        """ Time the enclosed block and record it as one item of work, see record(). Yields a Work for the block to add
+        its bytes to. An exception raised by the block is recorded as the item's error. """
+        work = Work()
+        start = time.perf_counter()
+        error = None
+        try:
+            yield work
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self.record(kind, name, time.perf_counter() - start, work.bytes, error)
+
+    def record(self, kind, name, seconds, nbytes=0, error=None):
+        """ Record one item of work, eg kind 'feed' and name its url. """
+        item = dict(kind=kind, name=name, seconds=seconds, bytes=nbytes, error=None if error is None else str(error))
+        with self._lock:
+            self.items.append(item)
+
+    def elapsed(self):
+        return time.perf_counter() - self._start
+
+    def kindtotals(self):
+        """ Return {kind: Counter(items, bytes, seconds, errors)}. """
+        totals = collections.defaultdict(collections.Counter)
+        for item in self.items:
+            t = totals[item['kind']]
+            t['items'] += 1
+            t['bytes'] += item['bytes']
+            t['seconds'] += item['seconds']
+            t['errors'] += item['error'] is not None
+        return totals
+
+    def summarylines(self, slowest=3):
+        lines = ['{} took {:.3f}s'.format(self.command, self.elapsed())]
+        for phase, seconds in sorted(self.phasetimes.items(), key=lambda x: -x[1]):
+            lines.append('  {:20} {:9.3f}s {:6} calls'.format(phase, seconds, self.phasecalls[phase]))
+        for kind, t in sorted(self.kindtotals().items()):
+            rate = t['bytes'] / t['seconds'] / 1024 if t['seconds'] else 0
+            lines.append('{} {}s: {} bytes in {:.3f}s ({:.1f} KiB/s), {} errors'.format(t['items'], kind, t['bytes'], t['seconds'], rate, t['errors']))
+            for item in sorted((x for x in self.items if x['kind'] == kind), key=lambda x: -x['seconds'])[:slowest]:
+                lines.append('  {:9.3f}s {}{}'.format(item['seconds'], item['name'], '' if item['error'] is None else ' ({})'.format(item['error'])))
+        return lines
+
+    def asdict(self):
+        return dict(command=self.command, started=self.started, seconds=self.elapsed(),
+                    phases={k: dict(seconds=v, calls=self.phasecalls[k]) for k, v in self.phasetimes.items()},
+                    counts=dict(self.counts), totals={k: dict(v) for k, v in self.kindtotals().items()}, items=self.items)
+
+    def prometheus(self):
+        """ Return the metrics in Prometheus text exposition format, for the node exporter textfile collector. """
+        cmd = 'command="{}"'.format(escapelabel(self.command))
+        lines = []
+        def metric(name, helptext, samples):
+            lines.append('# HELP scoop_{} {}'.format(name, helptext))
+            lines.append('# TYPE scoop_{} gauge'.format(name))
+            for labels, value in samples:
+                lines.append('scoop_{}{{{}}} {}'.format(name, ','.join([cmd] + ['{}="{}"'.format(k, escapelabel(v)) for k, v in labels]), value))
+        metric('last_run_timestamp_seconds', 'When the command started.', [((), self.started)])
+        metric('duration_seconds', 'How long the command took.', [((), self.elapsed())])
+        metric('phase_seconds', 'Time spent in each phase.', [((('phase', k),), v) for k, v in sorted(self.phasetimes.items())])
+        metric('phase_calls', 'Number of times each phase ran.', [((('phase', k),), v) for k, v in sorted(self.phasecalls.items())])
+        metric('count', 'Command specific counters.', [((('name', k),), v) for k, v in sorted(self.counts.items())])
+        totals = sorted(self.kindtotals().items())
+        for field in ('items', 'bytes', 'seconds', 'errors'):
+            metric('{}_{}'.format('work', field), 'Total {} of feeds, downloads or playlists.'.format(field), [((('kind', k),), t[field]) for k, t in totals])
+        return '\n'.join(lines) + '\n'
+
+    def report(self, stats=False, profile=None):
+        """ Print the summary if stats is set, and write the metrics to the file profile if given. """
+        if stats:
+            for line in self.summarylines():
+                print(line)
+        if profile is not None:
+            self.write(profile)
+
+    def write(self, filename):
+        """ Write metrics to filename, as a Prometheus textfile if it ends with .prom, otherwise as JSON.
+        The file is replaced in one step so that collectors never read a partial file. """
+        if filename.endswith('.prom'):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.asdict(), indent=2) + '\n'
+        tmpfile = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmpfile, 'w') as f:
+            f.write(text)
+        os.replace(tmpfile, filename)
+
+class Work:
+    """ An item of work being timed by Metrics.work. """
+
+    def __init__(self):
+        self.bytes = 0
+
+def escapelabel(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
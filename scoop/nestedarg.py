@@ -15,18 +15,37 @@ This gives a visual indication for the hierarchy of command line options.
 ... args = parser.parse_args()
 ... args.subcommand()
 
+Building a large command tree can take a noticeable part of a short run. Passing the command named on the command
+line as selected skips building the options of all the other commands:
+
+>>> commands = NestedSubparser(parser.add_subparsers(), selected=commandword)
+
 """
 
 class NestedSubparser(object):
-    """ Argparse add subparser convenience class. Creates contexts for adding subparser options. """
-    def __init__(self, subparsers):
+    """ Argparse add subparser convenience class. Creates contexts for adding subparser options.
+    If selected is given, only the subparser with that name or alias has its options added. The others are still
+    listed in help, but their options and nested subparsers are discarded rather than built. """
+    def __init__(self, subparsers, selected=None):
         self.subparsers = subparsers
+        self.selected = selected
 
-    def __call__(self, *args, **kwargs):
-        subparser = self.subparsers.add_parser(*args, **kwargs)
+    def __call__(self, name, aliases=(), **kwargs):
+        subparser = self.subparsers.add_parser(name, aliases=aliases, **kwargs)
         subparser.set_defaults(errorhelp=subparser.print_usage)
+        if self.selected is not None and self.selected != name and self.selected not in aliases:
+            return _ContextDelegate(_Discard())
         return _ContextDelegate(subparser)
 
+class _Discard(object):
+    """ Stands in for the parser of a command that isn't being run, accepting and ignoring all calls. """
+
+    def __getattr__(self, name):
+        return self._discard
+
+    def _discard(self, *args, **kwargs):
+        return self
+
 class _ContextDelegate(object):
 
     def __init__(self, obj):
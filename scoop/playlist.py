@@ -3,40 +3,206 @@ Playlist writing module.
 Copyright (c) 2018-2020 Acke, see LICENSE file for allowable usage.
 """
 
+import collections
 import os
 
+from . import metrics
 from . import sql
 from . import util
 
-def playitems(db, dls):
+# A playlist to generate: its output file and download filters. newerthan is a timestamp. podtitles, if given, are the
+# exact titles of the podcasts to include, eg for podcast index playlists.
+Spec = collections.namedtuple('Spec', ['outfile', 'podcasttitle', 'episodetitle', 'newerthan', 'podtitles'], defaults=[None])
+
+class MediaCache:
+    """ Remembers media file and directory lookups so that playlists generated together only check each file once. """
+
+    def __init__(self):
+        self.files = {}
+        self.dirs = {}
+
+    def isfile(self, path):
+        try:
+            return self.files[path]
+        except KeyError:
+            self.files[path] = exists = os.path.isfile(path)
+            return exists
+
+    def listdir(self, destdir):
+        """ Return the set of names in destdir, or None if destdir doesn't exist. """
+        try:
+            return self.dirs[destdir]
+        except KeyError:
+            try:
+                names = frozenset(os.listdir(destdir))
+            except FileNotFoundError:
+                names = None
+            self.dirs[destdir] = names
+            return names
+
+def multipodcast(dls):
+    return len({x.podtitle for x in dls if x.podtitle is not None}) > 1
+
+def labeller(dls):
     # Omit podcast title if all episodes come from the same podcast.
-    if len({x.podtitle for x in dls if x.podtitle is not None}) > 1:
-        def makelabel(dl):
+    if multipodcast(dls):
+        def makelabel(d):
             return '{}: {}'.format(d.podtitle, d.eptitle)
     else:
-        def makelabel(dl):
+        def makelabel(d):
             return d.eptitle
+    return makelabel
+
+def mediapath(config, dl):
+    return os.path.join(util.getdestdir(config, dl.podtitle), dl.filename)
 
+def m3uentries(config, destdir, dls, makelabel=None):
+    if makelabel is None:
+        makelabel = labeller(dls)
     for d in dls:
-        label = makelabel(d)
-        fullpath = os.path.join(util.getdestdir(db, d.podtitle), d.filename)
-        # Only return if the file exists. Handles case where media has been deleted, moved, archived etc..
-        if os.path.isfile(fullpath):
-            yield label, fullpath
+        # We don't support media length/duration yet so hardcode -1 for now.
+        yield '#EXTINF:-1,{}\n{}\n\n'.format(makelabel(d), os.path.relpath(mediapath(config, d), destdir))
 
-def writem3u(db, filename, dls):
+def writem3u(config, filename, dls):
+    """ Write dls to the m3u playlist filename. Returns True if the file was written, or False if it already held the
+    same playlist. """
+    text = '#EXTM3U\n\n' + ''.join(m3uentries(config, os.path.dirname(filename), dls))
+    try:
+        with open(filename) as f:
+            if f.read() == text:
+                return False
+    except (FileNotFoundError, UnicodeDecodeError):
+        pass
     with open(filename, 'w+') as f:
-        print('#EXTM3U', file=f)
-        print('', file=f)
-        destdir = os.path.dirname(filename)
-        for label, fullpath in playitems(db, dls):
-            # We don't support media length/duration yet so hardcode -1 for now.
-            print('#EXTINF:-1,{}'.format(label), file=f)
-            print(os.path.relpath(fullpath, destdir), file=f)
-            print('', file=f)
-
-def makeplaylist(db, outfile, podcasttitle=None, episodetitle=None, newerthan=None):
-    dls = sql.getdls(db, podcasttitle=podcasttitle, episodetitle=episodetitle, statelist=['d'], newerthan=newerthan)
-    if dls:
-        writem3u(db, outfile, dls)
-        print('Wrote: {}'.format(outfile))
+        f.write(text)
+    return True
+
+def missingmedia(config, dls, cache):
+    """ Return True if the media file of any of dls is gone.
+    Lists each podcast directory once rather than checking every file. """
+    dirs = collections.defaultdict(set)
+    for d in dls:
+        dirs[util.getdestdir(config, d.podtitle)].add(d.filename)
+    for destdir, filenames in dirs.items():
+        present = cache.listdir(destdir)
+        if present is None or not filenames <= present:
+            return True
+    return False
+
+def saveplaylist(db, filename, dls, append=False):
+    """ Record the playlist file and its entries so the next update can be incremental. """
+    st = os.stat(filename)
+    sql.saveplaylist(db, filename, st.st_mtime_ns, st.st_size, [d.dlid for d in dls], append=append)
+
+def updatem3u(db, config, filename, dls, rebuild=False, cache=None):
+    """ Bring the playlist filename up to date with dls, returns True if the file was written.
+    Only new entries have their media checked. They are appended when they come after the existing entries, otherwise
+    the file is rewritten in dls order from the entries already tracked in the db.
+    The whole playlist is rebuilt and every file checked when rebuild is set, the playlist isn't tracked or has been
+    changed by something else, or any tracked media has gone missing. Rebuilds only write the file if its contents
+    change. """
+    if cache is None:
+        cache = MediaCache()
+    playlist = None if rebuild else sql.getplaylist(db, filename)
+    try:
+        st = os.stat(filename)
+    except FileNotFoundError:
+        playlist = None
+    if playlist is not None and (playlist.mtime, playlist.size) == (st.st_mtime_ns, st.st_size):
+        tracked = sql.getplaylistdlids(db, playlist)
+        kept = [d for d in dls if d.dlid in tracked]
+        if not missingmedia(config, kept, cache):
+            newdls = [d for d in dls if d.dlid not in tracked and cache.isfile(mediapath(config, d))]
+            if not newdls and len(kept) == len(tracked):
+                return False
+            positions = {d.dlid: i for i, d in enumerate(dls)}
+            appendable = len(kept) == len(tracked) and multipodcast(kept) == multipodcast(kept + newdls) and (not kept or positions[kept[-1].dlid] < positions[newdls[0].dlid])
+            if appendable:
+                with open(filename, 'a') as f:
+                    f.writelines(m3uentries(config, os.path.dirname(filename), newdls, makelabel=labeller(kept + newdls)))
+                saveplaylist(db, filename, newdls, append=True)
+            else:
+                keep = tracked.union(d.dlid for d in newdls)
+                entries = [d for d in dls if d.dlid in keep]
+                writem3u(config, filename, entries)
+                saveplaylist(db, filename, entries)
+            return True
+    # Only return entries whose files exist. Handles case where media has been deleted, moved, archived etc..
+    entries = [d for d in dls if cache.isfile(mediapath(config, d))]
+    written = writem3u(config, filename, entries)
+    saveplaylist(db, filename, entries)
+    return written
+
+def selectdls(db, dls, spec):
+    """ Return the dls that match spec, in playlist order. """
+    if spec.newerthan is not None:
+        dls = [d for d in dls if d.actioned is not None and d.actioned > spec.newerthan]
+    if spec.podtitles:
+        dls = [d for d in dls if d.podtitle in spec.podtitles]
+    if spec.podcasttitle and spec.podcasttitle.strip():
+        titles = sql.matchpodcasttitles(db, spec.podcasttitle)
+        dls = [d for d in dls if d.podtitle in titles]
+    if spec.episodetitle and spec.episodetitle.strip():
+        # Best matches first, as with getdls.
+        ranks = sql.matchepisoderanks(db, spec.episodetitle)
+        dls = sorted((d for d in dls if d.episodeid in ranks), key=lambda d: ranks[d.episodeid])
+    return dls
+
+def makeplaylists(db, specs, rebuild=False, meter=None):
+    """ Generate each playlist in specs. Downloads for the specs with a newerthan window are read in one query covering
+    the widest window, and those for specs without a window in one query of their podcasts, unless a spec needs the
+    whole library. Media file checks are shared between the playlists. Timings are added to meter. """
+    if not specs:
+        return
+    if meter is None:
+        meter = metrics.Metrics('makeplaylists')
+    config = sql.loadconfig(db)
+    cache = MediaCache()
+    windows = [s.newerthan for s in specs if s.newerthan is not None]
+    titles = {t for s in specs if s.newerthan is None for t in s.podtitles or []}
+    with meter.phase('db query'):
+        if any(s.newerthan is None and not s.podtitles for s in specs):
+            recent = bypodcast = sql.getdls(db, statelist=['d'])
+        else:
+            recent = sql.getdls(db, statelist=['d'], newerthan=min(windows)) if windows else []
+            bypodcast = sql.getdls(db, statelist=['d'], podtitles=sorted(titles)) if titles else []
+    for spec in specs:
+        with meter.phase('db match'):
+            specdls = selectdls(db, bypodcast if spec.newerthan is None else recent, spec)
+        if specdls:
+            outfile = os.path.abspath(spec.outfile)
+            with meter.phase('playlist write'), meter.work('playlist', outfile) as work:
+                written = updatem3u(db, config, outfile, specdls, rebuild=rebuild, cache=cache)
+                if written:
+                    work.bytes = os.path.getsize(outfile)
+            meter.count('written' if written else 'unchanged')
+            if written:
+                print('Wrote: {}'.format(outfile))
+    meter.count('media checks', len(cache.files) + len(cache.dirs))
+
+def listgen(db, specs, rebuild=False, stats=False, profile=None):
+    """ Generate the playlists in specs. stats prints a summary of the run, profile writes its metrics to the file
+    profile. """
+    meter = metrics.Metrics('listgen')
+    try:
+        makeplaylists(db, specs, rebuild=rebuild, meter=meter)
+    finally:
+        meter.report(stats=stats, profile=profile)
+
+def getsavedspecs(db):
+    """ Return the saved playlist Specs. Their newerthan is in days. """
+    return [Spec(row['filename'], row['podcast'], row['episode'], row['newerthan']) for row in sql.getlistspecs(db)]
+
+def savespecs(db, specs):
+    """ Save playlist specs, newerthan in days, to be generated by a plain listgen. """
+    for spec in specs:
+        sql.savelistspec(db, os.path.abspath(spec.outfile), spec.podcasttitle, spec.episodetitle, spec.newerthan)
+
+def forgetspecs(db, outfiles):
+    for outfile in outfiles:
+        sql.deletelistspec(db, os.path.abspath(outfile))
+
+def printsavedspecs(db):
+    for spec in getsavedspecs(db):
+        options = [('--podcast', spec.podcasttitle), ('--episode', spec.episodetitle), ('--newerthan', spec.newerthan)]
+        print(' '.join(['{} {!r}'.format(o, v) for o, v in options if v is not None] + [spec.outfile]))
@@ -0,0 +1,94 @@
+"""
+Feed polling schedule: when each podcast's rss is next worth fetching.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+A feed is polled at a fraction of its publishing interval, as learnt from the pubdates of its newest episodes, and
+backs off while the feed is quiet. The interval is kept between the minpoll and maxpoll config settings. Publisher
+hints, rss <ttl> and HTTP Cache-Control max-age and Retry-After, can lengthen it up to maxpoll. Hours and days listed
+in rss <skipHours> and <skipDays> are skipped over. Feeds that fail to fetch are retried after minpoll, backing off
+to maxpoll while they keep failing.
+"""
+import email.utils as eu
+import statistics
+import time
+
+from . import rssxml
+
+# Poll this many times per publishing interval.
+pollsperinterval = 8
+
+# Number of newest episode pubdates used to work out the publishing interval.
+cadencedepth = 10
+
+def isdue(podcast, now):
+    return podcast.nextcheck is None or podcast.nextcheck <= now
+
+def publishinterval(pubdates, now):
+    """ Return the expected seconds between episodes given the newest pubdates, or None if there's no history.
+    This is the median gap between episodes, or the time since the newest episode if that's longer. """
+    if not pubdates:
+        return None
+    pubdates = sorted(pubdates, reverse=True)
+    quiet = now - pubdates[0]
+    gaps = [a - b for a, b in zip(pubdates, pubdates[1:]) if a != b]
+    if not gaps:
+        return max(quiet, 0) or None
+    return max(statistics.median(gaps), quiet)
+
+def serverdelay(headers, now):
+    """ Return the seconds the server asks clients to wait before fetching again, from the Cache-Control max-age and
+    Retry-After response headers. """
+    delay = 0
+    for directive in headers.get('Cache-Control', '').split(','):
+        name, _, value = directive.strip().partition('=')
+        if name.lower() == 'max-age':
+            try:
+                delay = max(delay, int(value.strip('"')))
+            except ValueError:
+                pass
+    retryafter = headers.get('Retry-After')
+    if retryafter:
+        try:
+            delay = max(delay, int(retryafter))
+        except ValueError:
+            try:
+                delay = max(delay, eu.parsedate_to_datetime(retryafter).timestamp() - now)
+            except (TypeError, ValueError):
+                pass
+    return int(delay)
+
+def parsehours(skiphours):
+    return {int(h) for h in skiphours.split(',')} if skiphours else set()
+
+def parsedays(skipdays):
+    return set(skipdays.split(',')) if skipdays else set()
+
+def skipforward(ts, skiphours=None, skipdays=None):
+    """ Return ts, moved on to the start of the first hour that isn't in skiphours or skipdays. Hours and days are GMT,
+    as in rss. ts is returned unchanged if every hour is skipped. """
+    hours = parsehours(skiphours)
+    days = parsedays(skipdays)
+    t = ts
+    # A week and a bit covers every combination.
+    for _ in range(8 * 24):
+        tm = time.gmtime(t)
+        if tm.tm_hour not in hours and rssxml.weekdays[tm.tm_wday] not in days:
+            return t
+        t = (t // 3600 + 1) * 3600
+    return ts
+
+def retrycheck(config, now, failures, skiphours=None, skipdays=None):
+    """ Return when to fetch a feed again after failures fetches in a row have failed. The wait doubles with each
+    failure, from minpoll up to maxpoll. """
+    wait = min(config.minpoll * 2 ** min(failures - 1, 32), config.maxpoll)
+    return skipforward(int(now + wait), skiphours, skipdays)
+
+def nextcheck(config, now, pubdates, ttl=None, skiphours=None, skipdays=None, delay=0):
+    """ Return when the feed should next be fetched. ttl is in minutes, delay in seconds. """
+    interval = publishinterval(pubdates, now)
+    if interval is None:
+        interval = config.minpoll
+    else:
+        interval = min(max(interval / pollsperinterval, config.minpoll), config.maxpoll)
+    hint = min(max((ttl or 0) * 60, delay), config.maxpoll)
+    return skipforward(int(now + max(interval, hint)), skiphours, skipdays)
@@ -6,10 +6,22 @@ RSS 2.0 Spec:
 https://cyber.harvard.edu/rss/rss.html
 ATOM Spec:
 http://tools.ietf.org/html/rfc4287
+
+Feeds are streamed through one of several parser backends, which all produce the same events for RssStream. expat,
+which skips building elements, is the default. etree (ElementTree) and lxml, if installed, build each item element.
+tests/test_rssxml.py and benchmarks/rssparse.py check them against each other.
 """
 # Python standard modules.
 import email.utils as eu
+import functools
 import xml.etree.ElementTree as et
+import xml.parsers.expat as expat
+
+# Optional modules.
+try:
+    import lxml.etree as lxmletree
+except ImportError:
+    lxmletree = None
 
 # Local modules.
 
@@ -20,69 +32,330 @@ xmlns = {
     'media':	"http://search.yahoo.com/mrss/",
     }
 
-def podcastdict(root, rssurl):
-    """ Create a podcast dict from rss xml. """
-    # rss.channel.title
-    chan = root.find('channel')
-    # The 3 elements below are required for RSS channels so not checking for now.
-    title = chan.find('title').text
-    descr = chan.find('description').text
-    homepage = chan.find('link').text
-    return dict(title=title, rssurl=rssurl, description=descr, homepage=homepage)
-
-def episodedicts(root):
-    # RSS podcast episode iterator.
-    # podcast iter / parse rss | atom | yahoo-media | itunes etc
-    chan = root.find('channel')
-    for x in chan.findall('item'):
-        # All elements of an 'item' are optional, but there must be at least one of 'title' or 'description'.
-        # Remove trailing whitespace/newlines (rstrip) from title and description fields.
-        try:
-            title = x.find('title').text.rstrip()
-        except AttributeError:
-            title = None
-        try:
-            description = x.find('description').text.rstrip()
-        except AttributeError:
-            description = None
-        if not any([title, description]):
-            # Invalid, skip item.
-            continue
-        guidnode = x.find('guid')
-        try:
-            guid = guidnode.text
-            permalink = True if guidnode.attrib['isPermaLink'] == 'true' else False
-        except AttributeError:
-            guid = None
-            permalink = None
-        try:
-            pubdatestr = x.find('pubDate').text
-        except AttributeError:
-            pubdate = None
-        else:
-            pubdate = round(eu.parsedate_to_datetime(pubdatestr).timestamp())
+weekdays = ('Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday')
+
+# Item child elements read by episodedict().
+itemtags = ('title', 'description', 'guid', 'pubDate', 'link', 'enclosure')
+
+# Channel child elements kept by RssStream, and those that are schedule hints.
+channeltags = ('title', 'description', 'link')
+hinttags = {'ttl': None, 'skipHours': 'hour', 'skipDays': 'day'}
+
+def itemfields(x):
+    """ Return the fields of item element x for episodedict(). """
+    fields = {}
+    for tag in itemtags:
+        node = x.find(tag)
+        if node is not None:
+            fields[tag] = (node.text, node.attrib)
+    return fields
+
+def episodedict(fields):
+    """ Create an episode dict from the fields of an rss item, {tag: (text, attrib)} of the first of each of itemtags
+    in the item. Text is None for empty elements. Returns None if the item is invalid. """
+    # All elements of an 'item' are optional, but there must be at least one of 'title' or 'description'.
+    # Remove trailing whitespace/newlines (rstrip) from title and description fields.
+    title, _ = fields.get('title', (None, None))
+    if title is not None:
+        title = title.rstrip()
+    description, _ = fields.get('description', (None, None))
+    if description is not None:
+        description = description.rstrip()
+    if not any([title, description]):
+        # Invalid, skip item.
+        return None
+    if 'guid' in fields:
+        guid, attrib = fields['guid']
+        # isPermaLink defaults to true.
+        permalink = attrib.get('isPermaLink', 'true') == 'true'
+    else:
+        guid = None
+        permalink = None
+    pubdatestr, _ = fields.get('pubDate', (None, None))
+    try:
+        pubdate = round(eu.parsedate_to_datetime(pubdatestr).timestamp())
+    except (TypeError, ValueError):
+        # Missing or not an RFC 822 date.
+        pubdate = None
+    link, _ = fields.get('link', (None, None))
+    _, attrib = fields.get('enclosure', (None, {}))
+    mediaurl = attrib.get('url')
+    if mediaurl is None:
+        # Episode does not contain media.
+        mediatype = None
+        medialength = None
+    else:
+        # RSS2.0 specifies that enclosure has 3 required attributes: url, type, and length.
+        # They're not always provided though. eg, length in "Bludging on the Blindside"!
+        # So make them optional.
+        mediatype = attrib.get('type', None)
         try:
-            link = x.find('link').text
-        except AttributeError:
-            link = None
-        medianode = x.find('enclosure')
+            medialength = int(attrib.get('length', -1))
+        except ValueError:
+            # eg, an empty length.
+            medialength = -1
+    return dict(guid=guid, permalink=permalink, title=title, description=description, mediaurl=mediaurl, mediatype=mediatype, medialength=medialength, pubdate=pubdate, link=link)
+
+def chunked(rssxmlbytes, size=0x10000):
+    """ Split rssxmlbytes into chunks for RssStream, without copying. """
+    view = memoryview(rssxmlbytes)
+    return (view[i:i + size] for i in range(0, len(view), size))
+
+# Parser backend events, see RssStream.
+ITEM = 'item'
+CHANNEL = 'channel'
+HINT = 'hint'
+
+class TreeParser:
+    """ Parser backend that builds each item as an element with an ElementTree style pull parser, then reads its
+    fields. Each item is removed from the tree once it has been read so memory use stays flat regardless of feed
+    size. """
+
+    def __init__(self, pullparser=et.XMLPullParser):
+        self.parser = pullparser(events=('start', 'end'))
+        # The root is depth 1, so channel child elements end at depth 3.
+        self.depth = 0
+        self.chan = None
+
+    def feed(self, chunk):
+        """ Parse chunk, returns a list of (ITEM, None, fields), (CHANNEL, tag, text) and (HINT, tag, value) events for
+        the channel child elements that it completes. """
+        self.parser.feed(chunk)
+        events = []
+        depth = self.depth
+        chan = self.chan
+        for event, elem in self.parser.read_events():
+            if event == 'start':
+                depth += 1
+                if depth == 1:
+                    assert elem.tag == 'rss'
+                elif depth == 2:
+                    chan = elem if elem.tag == 'channel' else None
+                continue
+            depth -= 1
+            if depth != 2 or chan is None:
+                continue
+            if elem.tag == 'item':
+                events.append((ITEM, None, itemfields(elem)))
+                chan.remove(elem)
+            elif elem.tag in channeltags:
+                events.append((CHANNEL, elem.tag, elem.text))
+            elif elem.tag in hinttags:
+                child = hinttags[elem.tag]
+                events.append((HINT, elem.tag, elem.text if child is None else [x.text for x in elem.findall(child)]))
+        self.depth = depth
+        self.chan = chan
+        return events
+
+    def close(self):
+        self.parser.close()
+
+class LxmlParser(TreeParser):
+    """ TreeParser using lxml. """
+
+    def __init__(self):
+        # Unlike ElementTree, lxml keeps comments and processing instructions, which would split element text.
+        super().__init__(functools.partial(lxmletree.XMLPullParser, remove_comments=True, remove_pis=True))
+
+    def feed(self, chunk):
+        # lxml won't take memoryview chunks.
+        return super().feed(bytes(chunk))
+
+class ExpatParser:
+    """ Parser backend that reads item fields straight from expat callbacks, without building elements. """
+
+    def __init__(self):
+        self.parser = expat.ParserCreate(namespace_separator=' ')
+        self.parser.buffer_text = True
+        self.parser.StartElementHandler = self.start
+        self.parser.EndElementHandler = self.end
+        self.events = []
+        # The root is depth 1, so channel child elements are depth 3 and item fields depth 4.
+        self.depth = 0
+        self.inchannel = False
+        # Fields of the item being read.
+        self.item = None
+        # Texts of the hour or day elements of the skipHours or skipDays being read.
+        self.hint = None
+        self.hintchild = None
+        # Text of the element at textdepth, which is read up to its first child element as in ElementTree. Character
+        # data is only handled, straight into text, while textopen.
+        self.text = None
+        self.textdepth = 0
+        self.textopen = False
+        self.attrib = None
+
+    def start(self, tag, attrib):
+        self.depth += 1
+        if self.textopen:
+            self.stoptext()
+        depth = self.depth
+        if depth == 1:
+            assert tag == 'rss'
+        elif depth == 2:
+            self.inchannel = tag == 'channel'
+        elif not self.inchannel:
+            pass
+        elif depth == 3:
+            if tag == 'item':
+                self.item = {}
+                # Most elements are within items, which have handlers of their own.
+                self.parser.StartElementHandler = self.itemstart
+                self.parser.EndElementHandler = self.itemend
+            elif hinttags.get(tag) is not None:
+                self.hint = []
+                self.hintchild = hinttags[tag]
+            elif tag in channeltags or tag in hinttags:
+                self.starttext(attrib)
+        elif depth == 4 and self.hint is not None and tag == self.hintchild:
+            self.starttext(attrib)
+
+    def itemstart(self, tag, attrib):
+        self.depth += 1
+        if self.textopen:
+            self.stoptext()
+        if self.depth == 4 and tag in itemtags and tag not in self.item:
+            self.starttext(attrib)
+
+    def itemend(self, tag):
+        depth = self.depth
+        self.depth -= 1
+        if self.textopen:
+            self.stoptext()
+        if depth == self.textdepth:
+            self.textdepth = 0
+            self.item[tag] = (''.join(self.text) or None, self.attrib)
+        elif depth == 3:
+            self.events.append((ITEM, None, self.item))
+            self.item = None
+            self.parser.StartElementHandler = self.start
+            self.parser.EndElementHandler = self.end
+
+    def starttext(self, attrib):
+        self.text = []
+        self.textdepth = self.depth
+        self.textopen = True
+        self.attrib = attrib
+        self.parser.CharacterDataHandler = self.text.append
+
+    def stoptext(self):
+        self.textopen = False
+        self.parser.CharacterDataHandler = None
+
+    def end(self, tag):
+        depth = self.depth
+        self.depth -= 1
+        if self.textopen:
+            self.stoptext()
+        text = None
+        collected = depth == self.textdepth
+        if collected:
+            self.textdepth = 0
+            text = ''.join(self.text) or None
+        if not self.inchannel or depth < 3:
+            return
+        if depth == 3:
+            if self.hint is not None:
+                self.events.append((HINT, tag, self.hint))
+                self.hint = None
+            elif collected and tag in channeltags:
+                self.events.append((CHANNEL, tag, text))
+            elif collected:
+                self.events.append((HINT, tag, text))
+        elif collected:
+            self.hint.append(text)
+
+    def feed(self, chunk):
+        self.parser.Parse(chunk, False)
+        events = self.events
+        self.events = []
+        return events
+
+    def close(self):
+        self.parser.Parse(b'', True)
+
+# Parser backends by name. lxml is only used if it's installed.
+backends = {'etree': TreeParser, 'expat': ExpatParser}
+if lxmletree is not None:
+    backends['lxml'] = LxmlParser
+
+# The backend RssStream uses by default.
+defaultbackend = 'expat'
+
+class RssStream:
+    """ Incremental rss parser, reads xml from an iterable of byte chunks with one of the parser backends. """
+
+    def __init__(self, chunks, knownguids=frozenset(), knownrun=5, backend=None):
+        self.chunks = chunks
+        self.knownguids = knownguids
+        self.knownrun = knownrun
+        self.backend = backends[backend or defaultbackend]
+        # Channel title, description and link as read so far.
+        self.channel = {}
+        # Channel ttl, skipHours and skipDays as read so far, see schedule().
+        self.hints = {}
+        # Set once the whole feed has been read.
+        self.complete = False
+        # Number of xml bytes read.
+        self.size = 0
+
+    def episodes(self):
+        """ Yield episode dicts in feed order, skipping those whose guid is in knownguids.
+        Stops reading chunks once knownrun known items in a row have been seen, as the rest of the feed is older.
+        A run, rather than the first known item, allows for feeds that reorder or back-date their newest items. """
+        parser = self.backend()
+        known = 0
+        for chunk in self.chunks:
+            self.size += len(chunk)
+            for event, tag, value in parser.feed(chunk):
+                if event == ITEM:
+                    ep = episodedict(value)
+                    if ep is None:
+                        continue
+                    if ep['guid'] in self.knownguids:
+                        known += 1
+                        if known >= self.knownrun:
+                            return
+                        continue
+                    known = 0
+                    yield ep
+                elif event == CHANNEL:
+                    self.channel[tag] = value
+                else:
+                    self.hints[tag] = value
+        parser.close()
+        self.complete = True
+
+    def schedule(self):
+        """ Return the channel's polling hints, see schedulehints(). """
+        return schedulehints(self.hints)
+
+    def podcastdict(self, rssurl):
+        """ Create a podcast dict from the channel elements read so far. """
+        return dict(title=self.channel.get('title'), rssurl=rssurl, description=self.channel.get('description'), homepage=self.channel.get('link'))
+
+def schedulehints(hints):
+    """ Return a dict of ttl (minutes), skiphours (GMT hours) and skipdays (day names) from channel hints, the text of
+    ttl and lists of the hour and day texts of skipHours and skipDays.
+    Hours and days are comma separated, and any that are invalid are left out. """
+    ttl = skiphours = skipdays = None
+    if 'ttl' in hints:
         try:
-            mediaurl = medianode.attrib['url']
-        except AttributeError as e:
-            # Episode does not contain media.
-            mediaurl = None
-            mediatype = None
-            medialength = None
-        else:
-            # RSS2.0 specifies that enclosure has 3 required attributes: url, type, and length.
-            # They're not always provided though. eg, length in "Bludging on the Blindside"!
-            # So make them optional.
-            mediatype = medianode.attrib.get('type', None)
-            medialength = int(medianode.attrib.get('length', -1))
-        ep = dict(guid=guid, permalink=permalink, title=title, description=description, mediaurl=mediaurl, mediatype=mediatype, medialength=medialength, pubdate=pubdate, link=link)
-        yield ep
-
-def getxmltree(rssxmlstr):
-    root = et.fromstring(rssxmlstr)
-    assert root.tag == 'rss'
-    return root
+            ttl = int(hints['ttl'].strip())
+        except (AttributeError, ValueError):
+            pass
+    if 'skipHours' in hints:
+        hours = set()
+        for h in hints['skipHours']:
+            try:
+                hour = int(h.strip())
+            except (AttributeError, ValueError):
+                continue
+            # Some feeds use 24 for midnight.
+            if 0 <= hour <= 24:
+                hours.add(hour % 24)
+        skiphours = ','.join(str(h) for h in sorted(hours)) or None
+    if 'skipDays' in hints:
+        days = [d.strip().capitalize() for d in hints['skipDays'] if d]
+        skipdays = ','.join(d for d in days if d in weekdays) or None
+    return dict(ttl=ttl, skiphours=skiphours, skipdays=skipdays)
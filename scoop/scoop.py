@@ -4,29 +4,39 @@ Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
 """
 
 import collections
-import datetime
+import concurrent.futures as cf
+import contextlib
+import gzip
+import hashlib
+import http.client
+import itertools
+import operator
 import os
+import socket
 import sys
+import threading
+import time
+import urllib.error as ue
 import urllib.parse as up
-import urllib.request as ur
 
+from . import dlsched
+from . import httppool
+from . import metrics
 from . import playlist
+from . import poll
 from . import rssxml
 from . import sql
 from . import util
 
-def openurl(db, url):
-    """ Return a url file pointer object. """
-    agent = sql.getconfig(db, 'useragent')['value']
-    req = ur.Request(url, headers={'User-Agent': agent})
-    return ur.urlopen(req)
+def urlhost(url):
+    return up.urlsplit(url).netloc
 
 def urlfpfilename(urlfp):
     """ Return filename from url file pointer object. """
     # Some podcast will contain items whose URLs *all* have the same filename.
     # These URLs will redirect to things that look like a filename we can use.
-    urlobj = ur.urlparse(urlfp.url)
-    fullpath = ur.unquote(urlobj.path)
+    urlobj = up.urlparse(urlfp.url)
+    fullpath = up.unquote(urlobj.path)
     if urlobj.query:
         # I have one podcast that includes a query string with the filename:
         # [('sv', '2015-04-05'), ('sr', 'b'), ('si', 'private'), ('sig', 'Bdh....'), ('se', '2018-07-24T12:56:40Z'), ('rscd', 'attachment; filename="xx.mp3"')]")]
@@ -46,156 +56,693 @@ def urlfpfilename(urlfp):
     _, filename = os.path.split(fullpath)
     return filename
 
-def downloadrss(db, rssurl, cache=False):
-    urlfp = openurl(db, rssurl)
+# A downloaded media file, its size in bytes and sha256 hex digest.
+Media = collections.namedtuple('Media', ['filename', 'size', 'sha256'])
+
+# Tries at a download that fails partway, eg from a dropped connection, before it is marked as an error.
+maxattempts = 5
+
+# A downloaded feed. status is the HTTP status, and delay is how many seconds the server asked for before the next
+# fetch. The rest are left at their defaults when the feed isn't downloaded or parsed: xmlbytes is the feed if kept,
+# and gzipbytes the same gzipped as the server sent it. podcast and episodes are as parsed, and schedule holds the
+# channel's polling hints. size and wiresize are the feed's bytes after and before decompression.
+Rss = collections.namedtuple('Rss', ['status', 'etag', 'lastmodified', 'delay', 'xmlbytes', 'podcast', 'episodes', 'digest', 'size', 'schedule', 'wiresize', 'gzipbytes'],
+                             defaults=[None, None, (), None, 0, None, 0, None])
+
+def openrss(pool, rssurl, etag=None, lastmodified=None):
+    """ Return (urlfp, status, etag, lastmodified, delay) for rssurl.
+    The etag and lastmodified validators are sent with the request, and the feed may come compressed, see
+    httppool.Decoder. urlfp is None if the feed is unchanged, or if the server is busy and has said when to retry. delay
+    is the server's Cache-Control max-age or Retry-After in seconds. """
+    headers = {'Accept-Encoding': httppool.acceptencoding}
+    if etag:
+        headers['If-None-Match'] = etag
+    if lastmodified:
+        headers['If-Modified-Since'] = lastmodified
     try:
-        rssxmlbytes = urlfp.read()
+        urlfp = pool.open(rssurl, headers)
+    except ue.HTTPError as e:
+        if e.code == 304:
+            # Not Modified. The server may have sent fresh validators, otherwise keep the current ones.
+            return None, e.code, e.headers.get('ETag', etag), e.headers.get('Last-Modified', lastmodified), poll.serverdelay(e.headers, time.time())
+        if e.code in (429, 503) and e.headers.get('Retry-After'):
+            # Too Many Requests or Service Unavailable, come back later.
+            return None, e.code, etag, lastmodified, poll.serverdelay(e.headers, time.time())
+        raise
+    return urlfp, urlfp.status, urlfp.headers.get('ETag'), urlfp.headers.get('Last-Modified'), poll.serverdelay(urlfp.headers, time.time())
+
+def rssdigest(rssxmlbytes):
+    return hashlib.sha256(rssxmlbytes).hexdigest()
+
+def streamschedule(stream):
+    """ Return the polling hints read by stream. Hints that weren't read, because the stream stopped at known episodes,
+    are left out so that the stored ones are kept. """
+    hints = stream.schedule()
+    if not stream.complete:
+        hints = {k: v for k, v in hints.items() if v is not None}
+    return hints
+
+class TimedReader:
+    """ Iterates over the chunks read from fp, adding up the time spent reading. """
+
+    def __init__(self, fp, size=0x10000):
+        self.fp = fp
+        self.size = size
+        self.seconds = 0
+        self.calls = 0
+
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            chunk = self.fp.read(self.size)
+            self.seconds += time.perf_counter() - start
+            self.calls += 1
+            if not chunk:
+                return
+            yield chunk
+
+class MediaReader:
+    """ Iterates over the chunks read from fp into one reused buffer, adding up the time spent reading. Each chunk is a
+    memoryview that is only valid until the next is read.
+    The chunk size adapts to the transfer: it doubles while reads fill it quickly, so that fast transfers take fewer
+    calls, and halves when reads are slow, so that throttling stays smooth on slow ones. """
+
+    minsize = 0x4000
+    maxsize = 0x100000
+    # Seconds a read should take.
+    target = 0.05
+
+    def __init__(self, fp, size=0x10000):
+        self.fp = fp
+        self.size = size
+        self.buffer = memoryview(bytearray(self.maxsize))
+        self.seconds = 0
+        self.calls = 0
+
+    def __iter__(self):
+        while True:
+            start = time.perf_counter()
+            n = self.fp.readinto(self.buffer[:self.size])
+            seconds = time.perf_counter() - start
+            self.seconds += seconds
+            self.calls += 1
+            if not n:
+                return
+            yield self.buffer[:n]
+            if n == self.size and seconds < self.target / 2:
+                self.size = min(self.size * 2, self.maxsize)
+            elif seconds > self.target * 2:
+                self.size = max(self.size // 2, self.minsize)
+
+class MediaWriter:
+    """ Writes chunks to file f and digests them with hasher, adding up the time spent on each. fsync is the
+    config.fsync policy, see downloadepisode. Every fsync MiB written is flushed to disk. """
+
+    def __init__(self, f, hasher, fsync=None):
+        self.f = f
+        self.hasher = hasher
+        self.fsync = fsync
+        self.unsynced = 0
+        # Seconds and calls, by meter phase.
+        self.seconds = collections.Counter()
+        self.calls = collections.Counter()
+
+    def write(self, chunk):
+        start = time.perf_counter()
+        self.f.write(chunk)
+        hashstart = time.perf_counter()
+        self.hasher.update(chunk)
+        self._add('file write', hashstart - start)
+        self._add('media hash', time.perf_counter() - hashstart)
+        self.unsynced += len(chunk)
+        if self.fsync and self.unsynced >= self.fsync * 0x100000:
+            self.sync()
+
+    def sync(self):
+        """ Flush the file to disk. """
+        start = time.perf_counter()
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self._add('file sync', time.perf_counter() - start)
+        self.unsynced = 0
+
+    def _add(self, phase, seconds):
+        self.seconds[phase] += seconds
+        self.calls[phase] += 1
+
+    def addtimes(self, meter):
+        """ Add the time spent writing, digesting and flushing to meter. """
+        for phase, seconds in self.seconds.items():
+            meter.addtime(phase, seconds, self.calls[phase])
+
+@contextlib.contextmanager
+def readphase(meter, reader, phase):
+    """ Time the enclosed block, which reads from the TimedReader reader, as phase. The time spent waiting on reads is
+    added to 'rss read' instead. """
+    start = time.perf_counter()
+    try:
+        yield
     finally:
-        urlfp.close()
-    # Cache rssxmlbytes to file if config.saverss = True
-    if cache:
-        poddict = rssxml.podcastdict(rssxml.getxmltree(rssxmlbytes), rssurl)
-        destdir = os.path.expanduser(sql.getconfig(db, 'downloaddir')['value'])
-        os.makedirs(destdir, exist_ok=True)
-        rssfile = os.path.join(destdir, '{}.rss'.format(poddict['title']))
-        with open(rssfile, 'w') as f:
-            f.write(str(rssxmlbytes, 'utf-8'))
-    return rssxml.getxmltree(rssxmlbytes)
-
-def addpodcasturl(db, rssurl, limit=False):
+        meter.addtime('rss read', reader.seconds, reader.calls)
+        meter.addtime(phase, time.perf_counter() - start - reader.seconds)
+
+def downloadrss(pool, rssurl, etag=None, lastmodified=None, digest=None, knownguids=frozenset(), keepxml=True, hostslot=contextlib.nullcontext(), meter=None):
+    """ Download and parse rssurl, returns an Rss tuple with the episodes that are newer than knownguids.
+    podcast is None if the server says the feed is not modified, or if the feed content still matches digest.
+    keepxml reads the whole feed so it can be digested and cached, keeping it as sent if the server gzipped it.
+    Otherwise the download stops along with the parser once it reaches episodes that are already known.
+    Timings are added to meter, the feed's own from when it gets its hostslot.
+    Does not touch the db so is safe to call from worker threads. """
+    if meter is None:
+        meter = metrics.Metrics('downloadrss')
+    with hostslot, meter.work('feed', rssurl) as work:
+        rss = fetchrss(pool, rssurl, etag, lastmodified, digest, knownguids, keepxml, meter)
+        work.bytes = rss.size
+        return rss
+
+def fetchrss(pool, rssurl, etag, lastmodified, digest, knownguids, keepxml, meter):
+    """ Fetch and parse rssurl for downloadrss. """
+    urlfp, status, etag, lastmodified, delay = openrss(pool, rssurl, etag, lastmodified)
+    if urlfp is None:
+        return Rss(status=status, etag=etag, lastmodified=lastmodified, delay=delay, digest=digest)
+    with urlfp:
+        reader = TimedReader(urlfp)
+        decoder = httppool.Decoder(reader, urlfp.headers.get('Content-Encoding'), keepgzip=keepxml)
+        if not keepxml:
+            with readphase(meter, reader, 'rss parse'):
+                stream = rssxml.RssStream(decoder, knownguids)
+                episodes = list(stream.episodes())
+            # Without the whole feed there's no digest.
+            return Rss(status=status, etag=etag, lastmodified=lastmodified, delay=delay, podcast=stream.podcastdict(rssurl), episodes=episodes, size=stream.size, schedule=streamschedule(stream), wiresize=decoder.wirebytes)
+        with readphase(meter, reader, 'rss decode'):
+            rssxmlbytes = b''.join(decoder)
+    with meter.phase('rss parse'):
+        newdigest = rssdigest(rssxmlbytes)
+        if newdigest == digest:
+            # Plenty of servers don't support conditional requests, so skip parsing if the content is the same as last time.
+            return Rss(status=status, etag=etag, lastmodified=lastmodified, delay=delay, xmlbytes=rssxmlbytes, digest=digest, size=len(rssxmlbytes), wiresize=decoder.wirebytes)
+        stream = rssxml.RssStream(rssxml.chunked(rssxmlbytes), knownguids)
+        episodes = list(stream.episodes())
+    return Rss(status=status, etag=etag, lastmodified=lastmodified, delay=delay, xmlbytes=rssxmlbytes, podcast=stream.podcastdict(rssurl), episodes=episodes, digest=newdigest, size=len(rssxmlbytes), schedule=streamschedule(stream), wiresize=decoder.wirebytes, gzipbytes=decoder.gzipbytes)
+
+def rsscachepath(config, podcast):
+    return os.path.join(config.downloaddir, '.rss', '{}.rss.gz'.format(podcast.podcastid))
+
+def cacherss(config, podcast, rss):
+    """ Save podcast's rss, gzipped, to the download directory. A feed the server sent gzipped is saved as it came.
+    Returns the number of bytes written. """
+    gzipbytes = rss.gzipbytes
+    if gzipbytes is None:
+        gzipbytes = gzip.compress(rss.xmlbytes, compresslevel=6)
+    rssfile = rsscachepath(config, podcast)
+    os.makedirs(os.path.dirname(rssfile), exist_ok=True)
+    # Replace the old copy in one step, so that the cache always holds a whole feed.
+    tmpfile = rssfile + '.tmp'
+    with open(tmpfile, 'wb') as f:
+        f.write(gzipbytes)
+    os.replace(tmpfile, rssfile)
+    return len(gzipbytes)
+
+def newpool(config, maxidle=4):
+    """ Return a keep-alive HTTP connection pool using the configured user agent. """
+    return httppool.Pool(config.useragent, maxidle=maxidle)
+
+def addpodcasturl(db, rssurl, limit=False, podcast=None, meter=None, pool=None):
     """ Adds a new podcast from network URL to track.
-    Also add all the podcast episodes, as well as download items for 'limit' number of the newest episodes. """
-    root = downloadrss(db, rssurl, cache=sql.getconfig(db, 'saverss')['value'])
-    podcast = sql.addpodcast(db, rssxml.podcastdict(root, rssurl))
+    Also add all the podcast episodes, as well as download items for 'limit' number of the newest episodes.
+    podcast is the existing podcast row when syncing, its validators make the download conditional. """
+    config = sql.loadconfig(db)
+    if pool is None:
+        pool = newpool(config)
+    if podcast is None:
+        rss = downloadrss(pool, rssurl, keepxml=config.saverss, meter=meter)
+    else:
+        rss = downloadrss(pool, rssurl, etag=podcast.etag, lastmodified=podcast.lastmodified, digest=podcast.rssdigest, knownguids=sql.getguids(db, podcast), keepxml=config.saverss, meter=meter)
+    addpodcastrss(db, rssurl, rss, limit=limit, podcast=podcast, meter=meter)
+
+def savevalidators(db, podcast, rss, current=None):
+    """ Store rss validators for podcast if they differ from those of the current podcast row. """
+    validators = (rss.etag, rss.lastmodified, rss.digest)
+    if current is None or validators != (current.etag, current.lastmodified, current.rssdigest):
+        sql.setpodcastvalidators(db, podcast, *validators)
+
+def saveschedule(db, podcast, rss, changed):
+    """ Record that podcast's rss was just checked, and when to check it next. """
+    now = int(time.time())
+    hints = dict(ttl=podcast.ttl, skiphours=podcast.skiphours, skipdays=podcast.skipdays)
+    if rss.schedule is not None:
+        hints.update(rss.schedule)
+    nextcheck = poll.nextcheck(sql.loadconfig(db), now, sql.getpubdates(db, podcast, poll.cadencedepth), delay=rss.delay, **hints)
+    sql.setpodcastschedule(db, podcast, lastchecked=now, lastchanged=now if changed else podcast.lastchanged, nextcheck=nextcheck, **hints)
+
+def addpodcastrss(db, rssurl, rss, limit=False, podcast=None, meter=None):
+    """ Add podcast, episodes and download orders from a downloaded Rss tuple. """
+    if meter is None:
+        meter = metrics.Metrics('addpodcastrss')
+    meter.count('feeds')
+    meter.count('bytes', rss.size)
+    meter.count('wirebytes', rss.wiresize)
+    if rss.podcast is None and podcast is None:
+        # A new feed can only come back empty if the server deferred the request.
+        raise ConnectionError('{}: server busy (HTTP {}), try again in {} seconds'.format(rssurl, rss.status, rss.delay))
+    if rss.podcast is None:
+        # Feed not modified since the last sync so there's nothing new.
+        if rss.status in (429, 503):
+            meter.count('deferred')
+        elif rss.xmlbytes is None:
+            meter.count('notmodified')
+        else:
+            meter.count('unchanged')
+        with meter.phase('db podcast'):
+            savevalidators(db, podcast, rss, podcast)
+            saveschedule(db, podcast, rss, changed=False)
+        printaddsummary(podcast, [], [])
+        return
+    meter.count('parsed')
+    with meter.phase('db podcast'):
+        newpodcast = sql.addpodcast(db, rss.podcast)
+        savevalidators(db, newpodcast, rss, podcast)
+    # Cache the rss if config.saverss = True
+    if rss.xmlbytes is not None:
+        with meter.phase('rss cache'):
+            meter.count('cachebytes', cacherss(sql.loadconfig(db), newpodcast, rss))
+        meter.count('cachedbytes', rss.size)
     # Insert podcast episodes.
-    episodes = sql.addepisodes(db, podcast, rssxml.episodedicts(root))
+    with meter.phase('db episodes'):
+        episodes = sql.addepisodes(db, newpodcast, rss.episodes)
+    meter.count('episodes', len(episodes))
     # Create dl orders for episodes.
-    downloads = sql.adddownloads(db, episodes, limit)
-    # Print addition summary.
+    with meter.phase('db downloads'):
+        downloads = sql.adddownloads(db, episodes, limit)
+    with meter.phase('db podcast'):
+        # Without a digest, only new episodes show that the feed changed.
+        saveschedule(db, newpodcast, rss, changed=podcast is None or bool(episodes) or rss.digest is not None)
+    printaddsummary(newpodcast, episodes, downloads)
+
+def printaddsummary(podcast, episodes, downloads):
     statii = collections.Counter()
     for dl in downloads:
         statii[dl.status] += 1
     print('{}: {} new episodes ({} waiting {} skipped)'.format(podcast.title, len(episodes), statii['w'], statii['s']))
 
-def printpodcasts(db, title=None):
-    podcasts = sql.getpodcasts(db, title)
-    for p in podcasts:
-        print(p.title)
-
-def editpodcast(db, podtitle, title=None, rssurl=None, stopped=None):
-    if any([title, rssurl]) or stopped is not None:
-        podcasts = sql.getpodcasts(db, podtitle)
-        # Make sure that podtitle matches only one podcast before changing anything.
-        np = len(podcasts)
-        if np == 0:
-            print('No podcasts found matching title "{}"'.format(podtitle))
-        elif np == 1:
-            sql.editpodcast(db, podtitle, title=title, rssurl=rssurl, stopped=stopped)
-            print('{}:'.format(podtitle))
-            if title:
-                print('title: {} -> {}'.format(podcasts[0].title, title))
-                try:
-                    os.rename(util.getdestdir(db, podcasts[0].title), util.getdestdir(db, title))
-                except FileNotFoundError:
-                    pass
-            if rssurl:
-                print('rssurl: {} -> {}'.format(podcasts[0].rssurl, rssurl))
-            if stopped is not None:
-                print('stopped: {} -> {}'.format(podcasts[0].stopped, stopped))
+def syncpodcasts(db, title=None, limit=False, jobs=1, hostjobs=2, force=False, stats=False, profile=None, pool=None):
+    """ Sync podcasts whose feeds are due to be checked, or all of them if force is set. A feed that fails is reported
+    and the sync carries on with the others. Returns the number of feeds that failed.
+    stats prints a summary of the sync, profile writes its metrics to the file profile. pool is an open connection
+    pool to use, otherwise one is opened for the sync. """
+    now = time.time()
+    podcasts = [p for p in sql.getpodcasts(db, title) if p.stopped is None]
+    meter = metrics.Metrics('podcast sync')
+    if not force:
+        due = [p for p in podcasts if poll.isdue(p, now)]
+        meter.count('notdue', len(podcasts) - len(due))
+        podcasts = due
+    ownpool = pool is None
+    if ownpool:
+        pool = newpool(sql.loadconfig(db), maxidle=hostjobs)
+    else:
+        pool.resetstats()
+    try:
+        if jobs > 1:
+            syncpodcastsconcurrent(db, podcasts, pool, limit=limit, jobs=jobs, hostjobs=hostjobs, meter=meter)
         else:
-            # np > 1
-            print('More than one podcast matches title "{}", please narrow your search'.format(podtitle))
+            for p in podcasts:
+                try:
+                    addpodcasturl(db, p.rssurl, limit=limit, podcast=p, meter=meter, pool=pool)
+                except Exception as e:
+                    failedfeed(db, p, e, meter)
+    finally:
+        if ownpool:
+            pool.close()
+        addpoolmetrics(meter, pool)
+        if stats:
+            printsyncstats(meter)
+            printpoolstats(pool)
+        meter.report(stats=stats, profile=profile)
+    return meter.counts['failed']
+
+def failedfeed(db, podcast, error, meter):
+    """ Print and count an error syncing podcast, eg a DNS failure or broken xml, and put off its next check. """
+    print('{}: {}'.format(podcast.title, error), file=sys.stderr)
+    meter.count('failed')
+    now = int(time.time())
+    failures = (podcast.failures or 0) + 1
+    sql.setpodcastfailure(db, podcast, lastchecked=now, nextcheck=poll.retrycheck(sql.loadconfig(db), now, failures, podcast.skiphours, podcast.skipdays), failures=failures)
+
+def printsyncstats(meter):
+    stats = meter.counts
+    print('{} feeds: {} not modified, {} unchanged content, {} parsed, {} deferred by the server'.format(stats['feeds'], stats['notmodified'], stats['unchanged'], stats['parsed'], stats['deferred']))
+    print('{} feeds failed, {} not due to be checked'.format(stats['failed'], stats['notdue']))
+    print('{} new episodes, {} rss bytes downloaded'.format(stats['episodes'], stats['bytes']))
+    if stats['bytes']:
+        print('{} rss bytes over the network, {:.0%} saved by compression'.format(stats['wirebytes'], 1 - stats['wirebytes'] / stats['bytes']))
+    if stats['cachedbytes']:
+        print('{} rss bytes cached in {} bytes, {:.0%} saved by compression'.format(stats['cachedbytes'], stats['cachebytes'], 1 - stats['cachebytes'] / stats['cachedbytes']))
+
+def printpoolstats(pool):
+    print('{} requests: {} connections opened, {} reused, {} redirects'.format(pool.stats['requests'], pool.stats['connections'], pool.stats['reused'], pool.stats['redirects']))
+
+def addpoolmetrics(meter, pool):
+    """ Add the pool's connection counts and timings to meter. """
+    for name, n in pool.stats.items():
+        meter.count('http ' + name, n)
+    meter.addtime('http connect', pool.times['connect'], pool.stats['connections'])
+    meter.addtime('http response', pool.times['response'], pool.stats['requests'])
+
+def interleavehosts(items, urlkey):
+    """ Return items reordered round-robin by the host of urlkey(item) so that workers don't all queue on one busy host. """
+    byhost = collections.defaultdict(list)
+    for x in items:
+        byhost[urlhost(urlkey(x))].append(x)
+    return [x for x in itertools.chain.from_iterable(itertools.zip_longest(*byhost.values())) if x is not None]
+
+def syncpodcastsconcurrent(db, podcasts, pool, limit=False, jobs=4, hostjobs=2, meter=None):
+    """ Fetch up to 'jobs' feeds at once, and no more than 'hostjobs' from any one host.
+    The calling thread is the only db writer. It handles results in podcast order so output matches a serial sync. """
+    keepxml = sql.loadconfig(db).saverss
+    hostslots = {h: threading.BoundedSemaphore(hostjobs) for h in {urlhost(p.rssurl) for p in podcasts}}
+    executor = cf.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        futures = {p.podcastid: executor.submit(downloadrss, pool, p.rssurl, etag=p.etag, lastmodified=p.lastmodified, digest=p.rssdigest, knownguids=sql.getguids(db, p), keepxml=keepxml, hostslot=hostslots[urlhost(p.rssurl)], meter=meter) for p in interleavehosts(podcasts, operator.attrgetter('rssurl'))}
+        for p in podcasts:
+            try:
+                addpodcastrss(db, p.rssurl, futures[p.podcastid].result(), limit=limit, podcast=p, meter=meter)
+            except Exception as e:
+                failedfeed(db, p, e, meter)
+    finally:
+        # Drop queued fetches if the sync is interrupted.
+        executor.shutdown(cancel_futures=True)
+
+def contentrangestart(urlfp):
+    """ Return the first byte position of a partial content response. """
+    # Content-Range is in format 'bytes 1000-1999/2000'.
+    try:
+        return int(urlfp.headers['Content-Range'].split()[1].split('-')[0])
+    except (AttributeError, IndexError, ValueError):
+        return None
+
+def mediasize(urlfp):
+    """ Return the full size of the media that urlfp is sending, or None if the server didn't say. """
+    if urlfp.status == 206:
+        # The total is after the slash in 'bytes 1000-1999/2000', it may be '*' if unknown.
+        try:
+            return int(urlfp.headers['Content-Range'].rsplit('/', 1)[1])
+        except (AttributeError, IndexError, ValueError):
+            return None
+    try:
+        return int(urlfp.headers['Content-Length'])
+    except (TypeError, ValueError):
+        return None
+
+def checksize(size, expected):
+    """ Raise ConnectionError if a download of size bytes doesn't match expected, the size the server gave, if any. """
+    if expected is not None and size != expected:
+        raise ConnectionError('Transfer closed with {} of {} bytes'.format(size, expected))
+
+def warnshort(dl, media):
+    """ Warn if media is shorter than the rss enclosure length of dl. rss lengths are often stale or made up, and media
+    with ads inserted or re-encoded is often shorter, so the download is kept. """
+    if dl.medialength and media.size < dl.medialength:
+        print('{}: {} is {} bytes, the rss length is {}'.format(dl.podtitle, media.filename, media.size, dl.medialength), file=sys.stderr)
+
+def mediavalidator(urlfp):
+    """ Return the validator identifying the version of the media urlfp sends, for If-Range: its ETag if strong,
+    otherwise its Last-Modified date. None if it has neither. """
+    etag = urlfp.headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return urlfp.headers.get('Last-Modified')
+
+def mediapartpath(destdir, dl):
+    """ Return the path that dl's media is downloaded to until complete. The final filename isn't known until after
+    redirects, so the part file is named for the episode. """
+    return os.path.join(destdir, '{}.part'.format(dl.episodeid))
+
+def validatorpath(partpath):
+    return partpath + '.ifrange'
+
+def savevalidator(partpath, validator):
+    """ Keep validator beside partpath, so that a resume only continues the same version of the media. """
+    if validator is None:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(validatorpath(partpath))
     else:
-        print('Nothing to do! Supply either a new title or rssurl.')
+        with open(validatorpath(partpath), 'w') as f:
+            f.write(validator)
 
-def syncpodcasts(db, title=None, limit=False):
-    podcasts = sql.getpodcasts(db, title)
-    for p in podcasts:
-        if p.stopped is None:
-            addpodcasturl(db, p.rssurl, limit=limit)
+def loadvalidator(partpath):
+    try:
+        with open(validatorpath(partpath)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+def removepart(partpath):
+    """ Delete an abandoned part file and its validator. """
+    for path in (partpath, validatorpath(partpath)):
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(path)
 
-def downloadepisode(db, dl):
-    # Download episode from dl.mediaurl > config:downloaddir/dl.podtitle/dl.mediaurl:filename
+def openmedia(pool, mediaurl, partpath):
+    """ Return a url file pointer for mediaurl.
+    If partpath holds the start of an interrupted download then only the remainder is requested, with If-Range so that
+    the server sends the whole media if it has changed since. The response status is 206 if the server resumes,
+    otherwise the full media is returned as usual. """
+    try:
+        offset = os.path.getsize(partpath)
+    except FileNotFoundError:
+        offset = 0
+    if offset:
+        validator = loadvalidator(partpath)
+        headers = {'Range': 'bytes={}-'.format(offset)}
+        if validator is not None:
+            headers['If-Range'] = validator
+        try:
+            urlfp = pool.open(mediaurl, headers)
+        except ue.HTTPError as e:
+            # Range Not Satisfiable, the server doesn't agree with the partial file so start again.
+            if e.code != 416:
+                raise
+        else:
+            if urlfp.status != 206:
+                return urlfp
+            # A part file as long as the media may hold space reserved by an attempt that was killed, so that's started
+            # again too.
+            # Servers that ignore If-Range still say which version they're sending.
+            current = validator is None or mediavalidator(urlfp) in (None, validator)
+            if current and contentrangestart(urlfp) == offset and mediasize(urlfp) != offset:
+                return urlfp
+            urlfp.close()
+    return pool.open(mediaurl)
+
+def downloadepisode(pool, dl, destdir, hostslot=contextlib.nullcontext(), throttle=None, fsync=None, meter=None):
+    """ Download episode from dl.mediaurl > destdir/dl.mediaurl:filename, returns a Media tuple.
+    Media is written to a .part file and only renamed into place once complete, and its size checked. The .part file
+    of an interrupted or short download is resumed on the next attempt. The file is digested as it's written.
+    Disk space is reserved up front when the server gives the size. fsync is the config.fsync policy: None to leave
+    flushing to the OS, 0 to flush the file once complete, or N to also flush every N MiB written.
+    Timings are added to meter, the download's own from when it gets its hostslot.
+    Does not touch the db so is safe to call from worker threads. """
+    if meter is None:
+        meter = metrics.Metrics('downloadepisode')
     # Ensure destdir exists.
-    destdir = util.getdestdir(db, dl.podtitle)
     os.makedirs(destdir, exist_ok=True)
-    urlfp = openurl(db, dl.mediaurl)
-    filename = urlfpfilename(urlfp)
-    fullpath = os.path.join(destdir, filename)
+    partpath = mediapartpath(destdir, dl)
+    with hostslot, meter.work('download', '{}: {}'.format(dl.podtitle, dl.eptitle)) as work:
+        with openmedia(pool, dl.mediaurl, partpath) as urlfp:
+            filename = urlfpfilename(urlfp)
+            resume = urlfp.status == 206
+            if resume:
+                with meter.phase('media hash'):
+                    hasher = util.hashfile(partpath)
+            else:
+                savevalidator(partpath, mediavalidator(urlfp))
+                hasher = hashlib.sha256()
+            expected = mediasize(urlfp)
+            reader = MediaReader(urlfp)
+            with open(partpath, 'r+b' if resume else 'wb') as f:
+                f.seek(0, os.SEEK_END)
+                writer = MediaWriter(f, hasher, fsync)
+                try:
+                    # The reserved space is trimmed off below. Were scoop killed first, openmedia starts again.
+                    util.preallocate(f, expected)
+                    for chunk in reader:
+                        writer.write(chunk)
+                        work.bytes += len(chunk)
+                        if throttle is not None:
+                            throttle.consume(len(chunk))
+                finally:
+                    f.truncate()
+                size = f.tell()
+                if fsync is not None:
+                    writer.sync()
+            meter.addtime('media read', reader.seconds, reader.calls)
+            writer.addtimes(meter)
+            # http.client returns a short read rather than raising if the connection drops early.
+            checksize(size, expected)
+        os.replace(partpath, os.path.join(destdir, filename))
+        savevalidator(partpath, None)
+        if fsync is not None:
+            util.syncdir(destdir)
+    return Media(filename, size, hasher.hexdigest())
+
+def markdownload(db, dl, media=None, error=None):
+    """ Record and print the outcome of a download. """
+    if error is None:
+        # Download success.
+        state = 'd'
+    else:
+        # Mark download failed.
+        state = 'e'
+        print(str(error), file=sys.stderr)
+    if media is None:
+        sql.markdl(db, dl, state, None)
+    else:
+        sql.markdl(db, dl, state, media.filename, media.size, media.sha256)
+    print('{} {:32} {}'.format(state, dl.podtitle, dl.eptitle))
+
+def retryable(error):
+    """ Return True if a download that failed with error may work if tried again, eg after a dropped connection or a
+    short transfer. """
+    if isinstance(error, ue.HTTPError):
+        return error.code == 429 or error.code >= 500
+    return isinstance(error, (OSError, http.client.HTTPException))
+
+def faileddownload(db, config, dl, error):
+    """ Record and print a failed download. One that may work if tried again is left waiting, and the next dl sync
+    resumes it from its part file, up to maxattempts tries. Otherwise the order is marked as an error and its part
+    file deleted. Returns True if the order will be retried. """
+    attempts = (dl.attempts or 0) + 1
+    if retryable(error) and attempts < maxattempts:
+        print('{} (try {} of {})'.format(error, attempts, maxattempts), file=sys.stderr)
+        sql.retrydl(db, dl, attempts)
+        print('{} {:32} {}'.format('w', dl.podtitle, dl.eptitle))
+        return True
+    markdownload(db, dl, error=error)
+    removepart(mediapartpath(util.getdestdir(config, dl.podtitle), dl))
+    return False
+
+def filematches(path, size):
+    """ Return True if path is a file of size bytes. """
     try:
-        with open(fullpath, 'wb') as f:
-            for chunkbytes in iter(lambda: urlfp.read(0x4000), b''):
-                f.write(chunkbytes)
-    finally:
-        urlfp.close()
-    return filename
+        return os.stat(path).st_size == size
+    except OSError:
+        return False
 
-def syncdls(db, updateindex=False):
-    dls = sql.getdls(db, statelist=['w'])
-    for d in dls:
+def reusecopy(db, config, dl):
+    """ Complete dl from an earlier download of the same episode whose file is still intact, instead of fetching it
+    again. Returns True if a copy was used. """
+    for copy in sql.getdlcopies(db, dl):
+        # The same episode, so the same podcast directory.
+        if filematches(util.getdlpath(config, copy), copy.size):
+            markdownload(db, dl, Media(copy.filename, copy.size, copy.sha256))
+            return True
+    return False
+
+def linkcopy(db, config, dl, media):
+    """ Replace the newly downloaded file of dl with a hard link to an identical file that's already downloaded, so
+    that media published in more than one podcast is only stored once. Returns True if the file was linked. """
+    path = os.path.join(util.getdestdir(config, dl.podtitle), media.filename)
+    for copy in sql.getdlcopies(db, dl, media.sha256):
+        copypath = util.getdlpath(config, copy)
+        if copy.size == media.size and filematches(copypath, copy.size) and not os.path.samefile(copypath, path):
+            return util.linkfile(copypath, path)
+    return False
+
+def leaseowner():
+    """ Name this process in download leases. """
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+def syncdls(db, updateindex=False, rebuildindex=False, jobs=1, hostjobs=2, maxrate=None, stats=False, profile=None, pool=None):
+    """ Download waiting orders, returns the orders tried. maxrate caps the total transfer rate, in bytes per second,
+    across all jobs. updateindex adds new downloads to each podcast's index playlist, rebuildindex rewrites the index
+    in full. stats prints a summary of the sync, profile writes its metrics to the file profile. pool is an open
+    connection pool to use, otherwise one is opened for the sync. """
+    config = sql.loadconfig(db)
+    throttle = None if maxrate is None else util.Throttle(maxrate)
+    meter = metrics.Metrics('dl sync')
+    ownpool = pool is None
+    if ownpool:
+        pool = newpool(config, maxidle=hostjobs)
+    else:
+        pool.resetstats()
+    try:
         try:
-            filename = downloadepisode(db, d)
-        except Exception as e:
-            # Mark download failed.
-            state = 'e'
-            print(str(e), file=sys.stderr)
-            filename = None
-        else:
-            # Download success.
-            state = 'd'
-        sql.markdl(db, d, state, filename)
-        print('{} {:32} {}'.format(state, d.podtitle, d.eptitle))
-    if updateindex and dls:
-        # Update the index playlist for each podcast that had new episodes downloaded.
-        indexfile = sql.getconfig(db, 'indexfile')['value']
-        for podtitle in sorted({p.podtitle for p in dls}):
-            outfile = os.path.join(util.getdestdir(db, podtitle), indexfile)
-            playlist.makeplaylist(db, outfile, podcasttitle=podtitle)
-
-def getmaxpodtitlelen(lst):
-    return len(max(lst, key=lambda x: len(x.podtitle)).podtitle)
-
-def printepisodes(db, podcasttitle=None, episodetitle=None):
-    episodes = sql.getepisodes(db, podcasttitle=podcasttitle, episodetitle=episodetitle)
-    maxtitle = getmaxpodtitlelen(episodes)
-    fmt = '{:<5} {:' + str(maxtitle) + '} {} {}'
-    for e in episodes:
-        print(fmt.format(e.episodeid, e.podtitle, datetime.date.fromtimestamp(e.pubdate), e.title))
-
-def makedlsprintlines(dls):
-    maxtitle = getmaxpodtitlelen(dls)
-    fmt = '{} {:' + str(maxtitle) + '} {}'
-    return (fmt.format(d.status, d.podtitle, d.eptitle) for d in dls)
-
-def insertdls(db, episodes):
-    """ Insert new dl orders for each episode in episodes. """
-    if episodes:
-        dlorders = sql.adddownloads(db, episodes, limit=False)
-        print('\n'.join(makedlsprintlines(dlorders)))
-
-def dlnewepisodes(db):
-    """ Adds download orders for new episodes. """
-    insertdls(db, sql.getnewepisodes(db))
-
-def dloldepisodes(db, idlist=None, podcasttitle=None, episodetitle=None):
-    """ Create dl orders for old/existing episodes. """
-    episodes = sql.getepisodes(db, idlist=idlist, podcasttitle=podcasttitle, episodetitle=episodetitle)
-    # Remove episodes that already have outstanding 'w' dl orders.
-    eids = [e.episodeid for e in episodes]
-    waitingdlids = frozenset(d.episodeid for d in sql.getdls(db, episodeids=eids, statelist=['w']))
-    insertdls(db, [e for e in episodes if e.episodeid not in waitingdlids])
-
-def printdls(db, podcasttitle=None, episodetitle=None, statelist=None, newerthan=None):
-    dls = sql.getdls(db, podcasttitle=podcasttitle, episodetitle=episodetitle, statelist=statelist, newerthan=newerthan)
-    print('\n'.join(makedlsprintlines(dls)))
-
-def printallconfig(db):
-    for row in sql.getallconfig(db):
-        print('{:16} {:16} {}'.format(row['key'], row['value'], row['description']))
-
-def printconfig(db, key):
-    row = sql.getconfig(db, key)
-    print('{:16} {}'.format(key, row['value']))
-
-def setconfig(db, key, value):
-    sql.setconfig(db, key, value)
+            dls = syncdlsconcurrent(db, config, pool, jobs=jobs, hostjobs=hostjobs, throttle=throttle, meter=meter)
+        finally:
+            if ownpool:
+                pool.close()
+            addpoolmetrics(meter, pool)
+        if stats:
+            printpoolstats(pool)
+        if updateindex and dls:
+            # Update the index playlist for each podcast that had new episodes downloaded.
+            specs = [playlist.Spec(os.path.join(util.getdestdir(config, t), config.indexfile), None, None, None, podtitles=[t]) for t in sorted({p.podtitle for p in dls})]
+            playlist.makeplaylists(db, specs, rebuild=rebuildindex, meter=meter)
+    finally:
+        meter.report(stats=stats, profile=profile)
+    return dls
+
+def syncdlsconcurrent(db, config, pool, jobs=4, hostjobs=2, throttle=None, meter=None):
+    """ Download up to 'jobs' orders at once, and no more than 'hostjobs' from any one host. Returns the orders tried.
+    Orders are leased from the db as workers become free, in queue order and as dlsched allows at the time, so that
+    other dl syncs sharing the db skip them. Leases are renewed while downloads run. If this process dies, its leases
+    lapse after config.leasetime and the orders are picked up again.
+    Workers only transfer files. Results are marked in the db by the calling thread as each download completes. """
+    if meter is None:
+        meter = metrics.Metrics('dl sync')
+    owner = leaseowner()
+    renewevery = config.leasetime / 3
+    hostslots = collections.defaultdict(lambda: threading.BoundedSemaphore(hostjobs))
+    futures = {}
+    done = []
+    restricted = False
+    executor = cf.ThreadPoolExecutor(max_workers=jobs)
+    try:
+        renewed = time.monotonic()
+        while True:
+            claimed = []
+            if len(futures) < jobs:
+                with meter.phase('db claim'):
+                    minpriority = dlsched.minpriority(db, config, time.time())
+                    claimed = sql.claimdls(db, owner, jobs - len(futures), config.leasetime, minpriority)
+                restricted = minpriority is not None
+                for d in interleavehosts(claimed, operator.attrgetter('mediaurl')):
+                    with meter.phase('db reuse'):
+                        reused = reusecopy(db, config, d)
+                    if reused:
+                        meter.count('reused')
+                        done.append(d)
+                        continue
+                    futures[executor.submit(downloadepisode, pool, d, util.getdestdir(config, d.podtitle), hostslot=hostslots[urlhost(d.mediaurl)], throttle=throttle, fsync=config.fsync, meter=meter)] = d
+            if not futures:
+                if claimed:
+                    # Every order claimed was reused, there may be more waiting.
+                    continue
+                break
+            finished, _ = cf.wait(futures, timeout=renewevery, return_when=cf.FIRST_COMPLETED)
+            for future in finished:
+                d = futures.pop(future)
+                with meter.phase('db mark'):
+                    try:
+                        media = future.result()
+                    except Exception as e:
+                        meter.count('retrying' if faileddownload(db, config, d, e) else 'failed')
+                    else:
+                        warnshort(d, media)
+                        markdownload(db, d, media)
+                        meter.count('downloaded')
+                        if linkcopy(db, config, d, media):
+                            meter.count('linked')
+                done.append(d)
+            if time.monotonic() - renewed >= renewevery:
+                sql.renewleases(db, owner, config.leasetime)
+                renewed = time.monotonic()
+        if restricted:
+            waiting = sql.countdls(db, 'w')
+            if waiting:
+                print('{} orders wait for the download window, or are over its budget. Orders of priority {} or higher download at any time'.format(waiting, config.urgentpriority))
+    finally:
+        executor.shutdown(cancel_futures=True)
+        sql.releaseleases(db, owner)
+    return done
@@ -3,21 +3,37 @@ Scoop command line processing module.
 Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
 """
 import argparse
-import datetime
 import os
+import sys
 import time
 
 from . import db
+from . import library
 from . import nestedarg
-from . import playlist
-from . import scoop
+# The network and playlist modules, scoop and playlist, are imported by the commands that use them so that quick
+# commands start without loading them. Likewise control, the daemon client, is only imported if a daemon is running.
 
 def usedb(func):
     def mkdb(args):
+        if args.dbobj is not None:
+            # Running in the daemon, which keeps its db open.
+            return func(args.dbobj, args)
         dbobj = db.DB(args.dbfile)
-        return func(dbobj, args)
+        ret = func(dbobj, args)
+        dbobj.optimize()
+        return ret
     return mkdb
 
+def socketpath(dbfile):
+    """ Return the control socket path of the daemon serving dbfile. """
+    return dbfile + '.sock'
+
+def argpath(args, path):
+    """ Return path relative to the directory scoop was run in, which for the daemon is the client's. """
+    if path is None or args.cwd is None:
+        return path
+    return os.path.join(args.cwd, os.path.expanduser(path))
+
 def numberrangestolist(numberranges):
     numlist = []
     for x in numberranges.split(','):
@@ -33,28 +49,31 @@ def daystotimestamp(days):
     if days is None:
         ts = None
     else:
-        # Create our newerthan timestamp.
-        # Using datetime and timedelta in this way will include the whole of days-ago.
-        daydiff = datetime.timedelta(days=days)
-        daysago = datetime.date.today() - daydiff
-        ts = int(time.mktime(daysago.timetuple()))
+        # Create our newerthan timestamp, midnight at the start of days-ago so that the whole of that day is included.
+        # mktime normalises a day of month below 1 into the previous months.
+        today = time.localtime()
+        ts = int(time.mktime((today.tm_year, today.tm_mon, today.tm_mday - days, 0, 0, 0, 0, 0, -1)))
     return ts
 
 @usedb
 def addpodcast(dbobj, args):
-    scoop.addpodcasturl(db=dbobj, rssurl=args.rssurl, limit=args.limit)
+    from . import scoop
+    try:
+        scoop.addpodcasturl(db=dbobj, rssurl=args.rssurl, limit=args.limit)
+    except (ConnectionError, ValueError) as e:
+        sys.exit(str(e))
 
 @usedb
 def lspodcasts(dbobj, args):
-    scoop.printpodcasts(db=dbobj, title=args.title)
+    library.printpodcasts(db=dbobj, title=args.title)
 
 @usedb
 def editpodcast(dbobj, args):
-    scoop.editpodcast(db=dbobj, podtitle=args.podtitle, title=args.title, rssurl=args.rssurl, stopped=args.stopped)
+    library.editpodcast(db=dbobj, podtitle=args.podtitle, title=args.title, rssurl=args.rssurl, stopped=args.stopped, priority=args.priority)
 
 @usedb
 def lsepisodes(dbobj, args):
-    scoop.printepisodes(db=dbobj, podcasttitle=args.podcasttitle, episodetitle=args.episodetitle)
+    library.printepisodes(db=dbobj, podcasttitle=args.podcasttitle, episodetitle=args.episodetitle)
 
 @usedb
 def dloldepisodes(dbobj, args):
@@ -63,16 +82,18 @@ def dloldepisodes(dbobj, args):
         idlist = []
     else:
         idlist = numberrangestolist(args.ids)
-    scoop.dloldepisodes(db=dbobj, idlist=idlist, podcasttitle=args.podcasttitle, episodetitle=args.episodetitle)
+    library.dloldepisodes(db=dbobj, idlist=idlist, podcasttitle=args.podcasttitle, episodetitle=args.episodetitle, priority=args.priority)
 
 @usedb
 def dlnewepisodes(dbobj, args):
-    scoop.dlnewepisodes(db=dbobj)
+    library.dlnewepisodes(db=dbobj)
 
 @usedb
 def lsdl(dbobj, args):
     # Convert args to status list.
-    if any([args.downloaded, args.errored, args.skipped, args.waiting]):
+    if args.queue:
+        statelist = ['w']
+    elif any([args.downloaded, args.errored, args.skipped, args.waiting]):
         # Find the ones selected and put in our list.
         statelist = list(filter(None, ['d' if args.downloaded else None,
                                        'e' if args.errored else None,
@@ -82,38 +103,115 @@ def lsdl(dbobj, args):
         # Show all by default.
         statelist = None
     ts = daystotimestamp(args.newerthan)
-    scoop.printdls(db=dbobj, podcasttitle=args.podcasttitle, episodetitle=args.episodetitle, statelist=statelist, newerthan=ts)
+    library.printdls(db=dbobj, podcasttitle=args.podcasttitle, episodetitle=args.episodetitle, statelist=statelist, newerthan=ts, queued=args.queue)
+
+@usedb
+def editdls(dbobj, args):
+    library.editdls(db=dbobj, podcasttitle=args.podcasttitle, episodetitle=args.episodetitle, priority=args.priority)
+
+@usedb
+def verifydls(dbobj, args):
+    from . import verify
+    if verify.verify(db=dbobj, podcasttitle=args.podcasttitle, episodetitle=args.episodetitle, jobs=args.jobs, quick=args.quick, requeue=args.requeue, linkcopies=args.dedup):
+        sys.exit(1)
+
+def parsepriority(value):
+    """ Parse a --priority value, a number or 'podcast' to follow the podcast's priority. """
+    return None if value == 'podcast' else int(value)
 
 @usedb
 def printallconfig(dbobj, args):
-    scoop.printallconfig(db=dbobj)
+    library.printallconfig(db=dbobj)
 
 @usedb
 def printconfig(dbobj, args):
-    scoop.printconfig(db=dbobj, key=args.key)
+    library.printconfig(db=dbobj, key=args.key)
 
 @usedb
 def setconfig(dbobj, args):
-    scoop.setconfig(db=dbobj, key=args.key, value=args.value)
+    try:
+        library.setconfig(db=dbobj, key=args.key, value=args.value)
+    except ValueError as e:
+        sys.exit(str(e))
 
 @usedb
 def syncpodcasts(dbobj, args):
-    scoop.syncpodcasts(db=dbobj, title=args.podcasttitle, limit=args.limit)
+    from . import scoop
+    if scoop.syncpodcasts(db=dbobj, title=args.podcasttitle, limit=args.limit, jobs=args.jobs, hostjobs=args.hostjobs, force=args.force, stats=args.stats, profile=argpath(args, args.profile), pool=args.pool):
+        sys.exit(1)
 
 @usedb
 def syncdls(dbobj, args):
-    scoop.syncdls(db=dbobj, updateindex=args.updateindex)
+    from . import scoop
+    maxrate = None if args.maxrate is None else args.maxrate * 1024
+    scoop.syncdls(db=dbobj, updateindex=args.updateindex or args.rebuildindex, rebuildindex=args.rebuildindex, jobs=args.jobs, hostjobs=args.hostjobs, maxrate=maxrate, stats=args.stats, profile=argpath(args, args.profile), pool=args.pool)
+
+def addlistspecargs(parser):
+    parser.add_argument('--podcast', default=None, type=str, metavar='TITLE', help='podcast title filter string')
+    parser.add_argument('--episode', default=None, type=str, metavar='TITLE', help='episode title filter string')
+    parser.add_argument('--newerthan', default=None, type=int, metavar='DAYS', help='only episodes downloaded within DAYS')
+    parser.add_argument('outfile', nargs='?', default=None, type=str, metavar='FILE', help='write playlist to FILE')
+    # Further playlists, each given as [--podcast TITLE] [--episode TITLE] [--newerthan DAYS] FILE.
+    parser.add_argument('more', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+
+def listspecargs(args):
+    """ Return the listgen playlist arguments, one namespace per FILE. """
+    specparser = argparse.ArgumentParser(prog='scoop listgen')
+    addlistspecargs(specparser)
+    speclist = []
+    while args.outfile is not None:
+        speclist.append(args)
+        args = specparser.parse_args(args.more)
+    if args.podcast or args.episode or args.newerthan is not None:
+        specparser.error('playlist options must be followed by FILE')
+    return speclist
 
 @usedb
 def makeplaylist(dbobj, args):
-    ts = daystotimestamp(args.newerthan)
-    playlist.makeplaylist(db=dbobj, outfile=args.outfile, podcasttitle=args.podcast, episodetitle=args.episode, newerthan=ts)
+    from . import playlist
+    speclist = listspecargs(args)
+    for a in speclist:
+        a.outfile = argpath(args, a.outfile)
+    if args.list:
+        playlist.printsavedspecs(db=dbobj)
+    elif args.forget:
+        playlist.forgetspecs(db=dbobj, outfiles=[a.outfile for a in speclist])
+    else:
+        if args.save:
+            playlist.savespecs(db=dbobj, specs=[playlist.Spec(a.outfile, a.podcast, a.episode, a.newerthan) for a in speclist])
+        if speclist:
+            specs = [playlist.Spec(a.outfile, a.podcast, a.episode, daystotimestamp(a.newerthan)) for a in speclist]
+        else:
+            specs = [s._replace(newerthan=daystotimestamp(s.newerthan)) for s in playlist.getsavedspecs(db=dbobj)]
+            if not specs:
+                sys.exit('listgen: no FILE given and no saved playlists')
+        playlist.listgen(db=dbobj, specs=specs, rebuild=args.rebuild, stats=args.stats, profile=argpath(args, args.profile))
 
-def main():
+def commandword(argv):
+    """ Return the command named in argv, the first argument that isn't a global option, or None. """
+    args = iter(argv)
+    for arg in args:
+        if arg == '--dbfile':
+            next(args, None)
+        elif not arg.startswith('-'):
+            return arg
+    return None
+
+def rundaemon(args):
+    from . import daemon
+    sys.exit(daemon.serve(dbfile=args.dbfile, interval=args.interval, jobs=args.jobs, hostjobs=args.hostjobs, updateindex=args.updateindex, listgen=args.listgen))
+
+def makeparser(argv):
+    """ Return the parser for the command line argv. """
     dbfile = os.path.expanduser('~/.scoop.db')
     parser = argparse.ArgumentParser()
     parser.add_argument('--dbfile', default=dbfile, help='scoop db file. Default: %(default)s')
-    command = nestedarg.NestedSubparser(parser.add_subparsers())
+    parser.add_argument('--nodaemon', default=False, action='store_true', help='run the command here even if a scoop daemon is running')
+    # The daemon sets dbobj, pool and cwd. network commands run on its sync thread, and enqueues commands have it
+    # download what they queue.
+    parser.set_defaults(dbobj=None, pool=None, cwd=None, network=False, enqueues=False)
+    # Only the options of the command being run are built.
+    command = nestedarg.NestedSubparser(parser.add_subparsers(), selected=commandword(argv))
     with command('config', aliases=['c'], help='scoop configuration') as c:
         subcommand = nestedarg.NestedSubparser(c.add_subparsers())
         with subcommand('get', aliases=['g'], help='get config value') as s:
@@ -129,7 +227,7 @@ def main():
         with subcommand('add', aliases=['new', 'a', 'n'], help='add a new podcast') as c:
             c.add_argument('rssurl', help='url for the rss feed')
             c.add_argument('--limit', default=False, type=int, help='number of newest episodes to get. Default: get all')
-            c.set_defaults(command=addpodcast)
+            c.set_defaults(command=addpodcast, network=True)
         with subcommand('ls', aliases=['l'], help='list podcasts') as c:
             c.add_argument('title', nargs='?', default=None, type=str, help='title search string')
             c.set_defaults(command=lspodcasts)
@@ -139,11 +237,17 @@ def main():
             c.add_argument('--rssurl', type=str, help='set podcast rssurl')
             c.add_argument('--start', dest='stopped', action='store_false', default=None)
             c.add_argument('--stop', dest='stopped', action='store_true', default=None)
+            c.add_argument('--priority', default=None, type=int, metavar='N', help="download priority of the podcast's episodes, higher first. New podcasts have priority 0")
             c.set_defaults(command=editpodcast)
         with subcommand('sync', aliases=['get', 'g', 's'], help='find new episodes for podcasts') as c:
             c.add_argument('--podcasttitle', default=None, type=str, help='podcast title search string')
             c.add_argument('--limit', default=False, type=int, help='number of newest episodes to get. Default: get all')
-            c.set_defaults(command=syncpodcasts)
+            c.add_argument('--jobs', default=1, type=int, metavar='N', help='fetch up to N feeds at once. Default: %(default)s')
+            c.add_argument('--hostjobs', default=2, type=int, metavar='N', help='fetch up to N feeds at once from any one host. Default: %(default)s')
+            c.add_argument('--force', default=False, action='store_true', help='fetch every feed, not only those due to be checked')
+            c.add_argument('--stats', default=False, action='store_true', help='print sync statistics and timings')
+            c.add_argument('--profile', default=None, type=str, metavar='FILE', help='write timings and counters to FILE, in Prometheus text format if FILE ends with .prom otherwise JSON')
+            c.set_defaults(command=syncpodcasts, network=True)
     with command('episode', aliases=['e'], help='episode actions') as c:
         subcommand = nestedarg.NestedSubparser(c.add_subparsers())
         with subcommand('ls', aliases=['l'], help='list episodes') as c:
@@ -156,7 +260,8 @@ def main():
             c.add_argument('--podcasttitle', default=None, type=str, help='podcast title search string')
             c.add_argument('--episodetitle', default=None, type=str, help='episode title search string')
             c.add_argument('--ids', default=None, type=str, help='episode id number list. eg, 1,4-7,9,10')
-            c.set_defaults(command=dloldepisodes)
+            c.add_argument('--priority', default=None, type=int, metavar='N', help="download priority of the orders. Default: the podcast's priority")
+            c.set_defaults(command=dloldepisodes, enqueues=True)
     with command('dl', aliases=['d', 'q'], help='download queue actions') as c:
         subcommand = nestedarg.NestedSubparser(c.add_subparsers())
         with subcommand('ls', aliases=['l'], help='list download orders') as c:
@@ -167,15 +272,56 @@ def main():
             c.add_argument('--errored', default=False, action='store_true', help='show errored orders')
             c.add_argument('--skipped', default=False, action='store_true', help='show skipped orders')
             c.add_argument('--waiting', default=False, action='store_true', help='show waiting orders')
+            c.add_argument('--queue', default=False, action='store_true', help='show waiting orders in the order dl sync downloads them')
             c.set_defaults(command=lsdl)
+        with subcommand('edit', aliases=['e'], help='set the priority of waiting download orders') as c:
+            c.add_argument('--podcasttitle', default=None, type=str, help='podcast title search string')
+            c.add_argument('--episodetitle', default=None, type=str, help='episode title search string')
+            c.add_argument('--priority', required=True, type=parsepriority, metavar='N', help="download priority, higher first, or 'podcast' for the podcast's priority")
+            c.set_defaults(command=editdls)
+        with subcommand('verify', aliases=['v'], help='check downloaded files against their recorded sizes and digests') as c:
+            c.add_argument('--podcasttitle', default=None, type=str, help='podcast title search string')
+            c.add_argument('--episodetitle', default=None, type=str, help='episode title search string')
+            c.add_argument('--jobs', default=4, type=int, metavar='N', help='check up to N files at once. Default: %(default)s')
+            c.add_argument('--quick', default=False, action='store_true', help='only check file sizes, digesting only files of unknown size')
+            c.add_argument('--requeue', default=False, action='store_true', help='return orders whose files are missing or damaged to the download queue')
+            c.add_argument('--dedup', default=False, action='store_true', help='hard-link identical files to one copy')
+            c.set_defaults(command=verifydls)
         with subcommand('sync', aliases=['s', 'get', 'g'], help='action waiting download orders') as c:
             c.add_argument('--updateindex', default=False, action='store_true', help='update playlist indexes')
-            c.set_defaults(command=syncdls)
-    with command('listgen', aliases=['l'], help='generate playlist from download items') as c:
-        c.add_argument('outfile', default=None, type=str, metavar='FILE', help='write playlist to FILE')
-        c.add_argument('--podcast', default=None, type=str, metavar='TITLE', help='podcast title filter string')
-        c.add_argument('--episode', default=None, type=str, metavar='TITLE', help='episode title filter string')
-        c.add_argument('--newerthan', default=None, type=int, metavar='DAYS', help='only episodes downloaded within DAYS')
+            c.add_argument('--rebuildindex', default=False, action='store_true', help='update playlist indexes, rewriting them in full')
+            c.add_argument('--jobs', default=1, type=int, metavar='N', help='download up to N episodes at once. Default: %(default)s')
+            c.add_argument('--hostjobs', default=2, type=int, metavar='N', help='download up to N episodes at once from any one host. Default: %(default)s')
+            c.add_argument('--maxrate', default=None, type=int, metavar='KIB', help='limit total download rate to KIB KiB/s. Default: unlimited')
+            c.add_argument('--stats', default=False, action='store_true', help='print download statistics and timings')
+            c.add_argument('--profile', default=None, type=str, metavar='FILE', help='write timings and counters to FILE, in Prometheus text format if FILE ends with .prom otherwise JSON')
+            c.set_defaults(command=syncdls, network=True)
+    with command('listgen', aliases=['l'], help='generate playlists from download items', usage='%(prog)s [-h] [--rebuild] [--save | --forget | --list] [--stats] [--profile FILE] [[--podcast TITLE] [--episode TITLE] [--newerthan DAYS] FILE ...]', description='Generate one or more playlists. Each FILE takes the filter options given before it. With no FILE, generates the saved playlists.') as c:
+        c.add_argument('--rebuild', default=False, action='store_true', help='rewrite whole playlists, rather than only adding new entries')
+        c.add_argument('--save', default=False, action='store_true', help='also save the playlists, to be generated by a plain listgen')
+        c.add_argument('--forget', default=False, action='store_true', help='remove the saved playlists for each FILE')
+        c.add_argument('--list', default=False, action='store_true', help='print the saved playlists')
+        c.add_argument('--stats', default=False, action='store_true', help='print playlist timings')
+        c.add_argument('--profile', default=None, type=str, metavar='FILE', help='write timings and counters to FILE, in Prometheus text format if FILE ends with .prom otherwise JSON')
+        addlistspecargs(c)
         c.set_defaults(command=makeplaylist)
-    args = parser.parse_args()
+    with command('daemon', help='keep running, syncing feeds and downloads as they fall due, and serve scoop commands') as c:
+        c.add_argument('--interval', default=3600, type=int, metavar='SECONDS', help='sync at least every SECONDS. Default: %(default)s')
+        c.add_argument('--jobs', default=4, type=int, metavar='N', help='fetch up to N feeds or episodes at once. Default: %(default)s')
+        c.add_argument('--hostjobs', default=2, type=int, metavar='N', help='fetch up to N feeds or episodes at once from any one host. Default: %(default)s')
+        c.add_argument('--updateindex', default=False, action='store_true', help='update playlist indexes after downloading')
+        c.add_argument('--listgen', default=False, action='store_true', help='generate the saved playlists after downloading')
+        c.set_defaults(command=rundaemon)
+    return parser
+
+def main():
+    argv = sys.argv[1:]
+    args = makeparser(argv).parse_args(argv)
+    path = socketpath(args.dbfile)
+    if args.command is not rundaemon and not args.nodaemon and os.path.exists(path):
+        # Hand the command to the running daemon.
+        from . import control
+        status = control.forward(path, argv, os.getcwd())
+        if status is not None:
+            sys.exit(status)
     args.command(args)
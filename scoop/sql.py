@@ -3,7 +3,9 @@ Scoop SQL commands.
 Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
 """
 import collections
+import json
 import os
+import re
 import time
 
 def makeinsertquery(query, columns):
@@ -19,25 +21,153 @@ addepsql = makeinsertquery('''INSERT OR IGNORE INTO
 episode ({})
 VALUES ({});''', epcols)
 
-dlcols = ['dlid', 'episodeid', 'status', 'added', 'actioned', 'filename']
+dlcols = ['dlid', 'episodeid', 'status', 'added', 'actioned', 'filename', 'priority']
 adddlsql = makeinsertquery('''INSERT OR IGNORE INTO
 dl ({})
 VALUES ({});''', dlcols)
 
+# Full text search filters. Podcast titles, and episode titles and descriptions, are indexed in fts5 tables.
+podcastfts = 'podcastid IN (SELECT rowid FROM podcastfts WHERE podcastfts MATCH ?)'
+episodefts = 'JOIN episodefts ON episodefts.rowid = e.episodeid'
+episodematch = 'episodefts MATCH ?'
+
+# Characters that fts5 indexes words by, a search word without any can't match.
+wordchar = re.compile(r'[^\W_]')
+
+# A download order's effective priority, its own or else its podcast's, and the order dl sync takes waiting orders in:
+# highest priority first, then newest episode first.
+dlpriority = 'IFNULL(d.priority, p.priority)'
+queueorder = [dlpriority + ' DESC', 'e.pubdate DESC', 'd.dlid']
+
+def ftsquery(text):
+    """ Convert a search string to an fts5 query matching text that has words starting with each of its words.
+    Returns '' if text has no searchable words. """
+    return ' '.join('"{}"*'.format(w.replace('"', '""')) for w in text.split() if wordchar.search(w))
+
+def podcastmatch(text, prefix=''):
+    """ Return a WHERE term and its values matching podcasts titled text, or whose title has words starting with each
+    word of text. prefix qualifies the podcast columns, eg 'p.'. Blank text matches every podcast. """
+    if not text.strip():
+        return '1', []
+    query = ftsquery(text)
+    exact = prefix + 'title = ?'
+    if not query:
+        # eg '???', which only an exact title can match.
+        return exact, [text]
+    return '({} OR {}{})'.format(exact, prefix, podcastfts), [text, query]
+
+def addepisodematch(text, queryelems, where, value, order):
+    """ Add the terms of an episode search to a query. Episodes whose title or description has words starting with each
+    word of text are matched, best match first. Text without searchable words matches episode titles exactly, and
+    blank text matches every episode. """
+    if not text.strip():
+        return
+    query = ftsquery(text)
+    if not query:
+        where.append('e.title = ?')
+        value.append(text)
+        return
+    queryelems.append(episodefts)
+    where.append(episodematch)
+    value.append(query)
+    order.insert(0, 'episodefts.rank')
+
 class Data:
+    """ Row object. Subclasses list their fields in __slots__, fields that aren't given are None. """
+    __slots__ = ()
 
     def __init__(self, **kwargs):
-        for k, v in kwargs.items():
-            setattr(self, k, v)
+        for k in self.__slots__:
+            setattr(self, k, kwargs.pop(k, None))
+        if kwargs:
+            raise TypeError('{} has no fields: {}'.format(type(self).__name__, ', '.join(kwargs)))
 
 class Podcast(Data):
-    pass
+    __slots__ = ('podcastid', 'title', 'rssurl', 'description', 'homepage', 'stopped', 'etag', 'lastmodified', 'rssdigest', 'lastchecked', 'lastchanged', 'nextcheck', 'ttl', 'skiphours', 'skipdays', 'priority', 'failures')
 
 class Episode(Data):
-    pass
+    __slots__ = ('podtitle', 'episodeid', 'podcastid', 'guid', 'permalink', 'mediaurl', 'mediatype', 'medialength', 'title', 'description', 'link', 'pubdate')
 
 class Download(Data):
-    pass
+    __slots__ = ('podtitle', 'eptitle', 'mediaurl', 'medialength', 'podpriority', 'dlid', 'episodeid', 'status', 'added', 'actioned', 'filename', 'leaseowner', 'leaseexpires', 'priority', 'size', 'sha256', 'attempts')
+
+    def effectivepriority(self):
+        """ Return the order's priority if set, otherwise its podcast's. """
+        return self.podpriority if self.priority is None else self.priority
+
+class Playlist(Data):
+    __slots__ = ('playlistid', 'filename', 'mtime', 'size')
+
+def rowfactory(cls):
+    """ Return a cursor row_factory that makes cls objects. Columns that cls has no field for are left out, so that
+    queries keep working when a newer schema adds columns. """
+    columns = None
+    def makerow(cursor, row):
+        nonlocal columns
+        if columns is None:
+            fields = set(cls.__slots__)
+            columns = [(i, x[0]) for i, x in enumerate(cursor.description) if x[0] in fields]
+        return cls(**{name: row[i] for i, name in columns})
+    return makerow
+
+def parsebool(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+def parsepath(value):
+    return os.path.expanduser(value)
+
+def parsewindows(value):
+    """ Parse comma separated HH:MM-HH:MM times of day into a list of (start, end) minutes after midnight. """
+    windows = []
+    for window in filter(None, (x.strip() for x in value.split(','))):
+        try:
+            start, end = (h * 60 + m for h, m in (map(int, t.split(':')) for t in window.split('-')))
+        except ValueError:
+            raise ValueError('Download window must be HH:MM-HH:MM: {}'.format(window))
+        windows.append((start % 1440, end % 1440))
+    return windows
+
+def parsefsync(value):
+    """ Parse the fsync policy: None for never, 0 to flush each file once complete, or N to also flush every N MiB. """
+    if value == 'never':
+        return None
+    if value == 'file':
+        return 0
+    try:
+        mib = int(value)
+    except ValueError:
+        mib = -1
+    if mib <= 0:
+        raise ValueError('fsync must be never, file or a number of MiB: {}'.format(value))
+    return mib
+
+class Config:
+    """ Typed config values, as attributes named for their config keys. """
+
+    # Value parsers for each config key. Keys not listed here are left as strings.
+    parsers = {
+        'downloaddir': parsepath,
+        'saverss': parsebool,
+        'schemaversion': int,
+        'busytimeout': int,
+        'leasetime': int,
+        'minpoll': int,
+        'maxpoll': int,
+        'dlwindow': parsewindows,
+        'dlbudget': int,
+        'urgentpriority': int,
+        'fsync': parsefsync,
+        }
+
+    def __init__(self, rows):
+        for row in rows:
+            setattr(self, row['key'], self.parsers.get(row['key'], str)(row['value']))
+
+def loadconfig(db):
+    """ Return the db Config. The config table is only read on first use, and again after setconfig. """
+    if db.config is None:
+        db.config = Config(getallconfig(db))
+    return db.config
 
 def getallconfig(db):
     with db as conn:
@@ -50,9 +180,17 @@ def getconfig(db, field):
         return curs.fetchone()
 
 def setconfig(db, field, value):
+    """ Set config field to value. Raises ValueError if value doesn't parse for a typed field. """
+    parser = Config.parsers.get(field)
+    if parser is not None:
+        try:
+            parser(value)
+        except ValueError as e:
+            raise ValueError('Bad value for {}: {}'.format(field, e))
     with db as conn:
         curs = conn.execute('UPDATE config SET value = ? WHERE key = ?', (value, field,))
         db.commit()
+    db.config = None
 
 def addpodcast(db, poddict, stopped=None):
     """ Adds a new podcast to the database, returns the new podcast object. """
@@ -69,27 +207,69 @@ def addpodcast(db, poddict, stopped=None):
             podcast = Podcast(**poddict)
     return podcast
 
+def setpodcastvalidators(db, podcast, etag, lastmodified, rssdigest):
+    """ Store the HTTP cache validators and content digest from the podcasts last rss download. """
+    with db as conn:
+        conn.execute('UPDATE podcast SET etag = ?, lastmodified = ?, rssdigest = ? WHERE podcastid = ?', (etag, lastmodified, rssdigest, podcast.podcastid))
+        db.commit()
+
+def setpodcastschedule(db, podcast, lastchecked, lastchanged, nextcheck, ttl, skiphours, skipdays):
+    """ Store when the podcast's rss was last checked and last changed, when it's next due, and its polling hints.
+    Clears any run of failed fetches. """
+    with db as conn:
+        conn.execute('UPDATE podcast SET lastchecked = ?, lastchanged = ?, nextcheck = ?, ttl = ?, skiphours = ?, skipdays = ?, failures = 0 WHERE podcastid = ?', (lastchecked, lastchanged, nextcheck, ttl, skiphours, skipdays, podcast.podcastid))
+        db.commit()
+
+def setpodcastfailure(db, podcast, lastchecked, nextcheck, failures):
+    """ Store a failed fetch of the podcast's rss, the number of failures in a row and when to try again. """
+    with db as conn:
+        conn.execute('UPDATE podcast SET lastchecked = ?, nextcheck = ?, failures = ? WHERE podcastid = ?', (lastchecked, nextcheck, failures, podcast.podcastid))
+        db.commit()
+
+def getnextcheck(db):
+    """ Return when the first active podcast is due to be checked, or None if there are none. Podcasts that have never
+    been checked are due now. """
+    with db as conn:
+        return conn.execute('SELECT MIN(IFNULL(nextcheck, 0)) FROM podcast WHERE stopped IS NULL').fetchone()[0]
+
+def getpubdates(db, podcast, limit):
+    """ Return the newest limit episode pubdates of podcast, newest first. """
+    with db as conn:
+        curs = conn.execute('SELECT pubdate FROM episode WHERE podcastid = ? AND pubdate IS NOT NULL ORDER BY pubdate DESC LIMIT ?', (podcast.podcastid, limit))
+        return [row[0] for row in curs]
+
+def getguids(db, podcast):
+    """ Return the set of episode guids stored for podcast. """
+    with db as conn:
+        curs = conn.execute('SELECT guid FROM episode WHERE podcastid = ? AND guid IS NOT NULL', (podcast.podcastid,))
+        return frozenset(row[0] for row in curs)
+
 def getpodcastbyrssurl(rssurl, conn):
+    conn.row_factory = rowfactory(Podcast)
     curs = conn.execute('SELECT * FROM podcast WHERE rssurl = ?', (rssurl,))
-    return Podcast(**curs.fetchone())
+    return curs.fetchone()
+
+def getpodcastbytitle(db, title):
+    """ Return the podcast titled exactly title, or None. """
+    with db as conn:
+        conn.row_factory = rowfactory(Podcast)
+        return conn.execute('SELECT * FROM podcast WHERE title = ?', (title,)).fetchone()
 
 def getpodcasts(db, title=None):
     basequery = 'SELECT * FROM podcast'
     order = ' ORDER BY title'
     if title:
-        query = basequery + " WHERE title LIKE ?" + order
-        value = ('%{}%'.format(title),)
+        term, value = podcastmatch(title)
+        query = basequery + ' WHERE ' + term + order
     else:
         query = basequery + order
         value = ()
-    podcasts = []
     with db as conn:
-        curs = conn.execute(query, value)
-        for row in curs.fetchall():
-            podcasts.append(Podcast(**row))
-    return podcasts
+        conn.row_factory = rowfactory(Podcast)
+        return conn.execute(query, value).fetchall()
 
-def editpodcast(db, podcasttitle, title=None, rssurl=None, stopped=None):
+def editpodcast(db, podcast, title=None, rssurl=None, stopped=None, priority=None):
+    """ Change the given fields of podcast. """
     basequery = ['UPDATE podcast SET']
     setvalues = []
     values = []
@@ -99,6 +279,8 @@ def editpodcast(db, podcasttitle, title=None, rssurl=None, stopped=None):
     if rssurl:
         setvalues.append('rssurl = ?')
         values.append(rssurl)
+        # Check the new feed on the next sync, without the old feed's validators or polling hints.
+        setvalues.append('etag = NULL, lastmodified = NULL, rssdigest = NULL, nextcheck = NULL, ttl = NULL, skiphours = NULL, skipdays = NULL, failures = 0')
     if stopped is not None:
         setvalues.append('stopped = ?')
         if stopped:
@@ -106,39 +288,53 @@ def editpodcast(db, podcasttitle, title=None, rssurl=None, stopped=None):
         else:
             val = None
         values.append(val)
-    whereelems = ['WHERE title LIKE ?']
-    values.append('%{}%'.format(podcasttitle))
+    if priority is not None:
+        setvalues.append('priority = ?')
+        values.append(priority)
+    whereelems = ['WHERE podcastid = ?']
+    values.append(podcast.podcastid)
     query = ' '.join(basequery + [', '.join(setvalues)] + whereelems)
     with db as conn:
         conn.execute(query, values)
         db.commit()
 
-def getepisodes(db, idlist=None, podcasttitle=None, episodetitle=None):
-    queryelems = ['SELECT p.title as podtitle, e.* FROM episode as e JOIN podcast as p on e.podcastid = p.podcastid']
-    order = 'ORDER BY podtitle, e.pubdate'
+def episodequery(idlist=None, podcasttitle=None, episodetitle=None):
+    """ Return the FROM and WHERE clauses, ORDER BY terms and values of an episode query. """
+    queryelems = ['FROM episode as e JOIN podcast as p on e.podcastid = p.podcastid']
+    order = ['podtitle', 'e.pubdate']
     where = []
     value = []
     if idlist:
         where.append('e.episodeid IN ({})'.format(('?,' * len(idlist))[:-1]))
         value.extend(idlist)
     if podcasttitle:
-        where.append('p.title LIKE ?')
-        value.append('%{}%'.format(podcasttitle))
+        term, values = podcastmatch(podcasttitle, 'p.')
+        where.append(term)
+        value.extend(values)
     if episodetitle:
-        where.append('e.title LIKE ?')
-        value.append('%{}%'.format(episodetitle))
-    # Build the query.
+        addepisodematch(episodetitle, queryelems, where, value, order)
     if where:
         queryelems.append('WHERE')
         queryelems.append(' AND '.join(where))
-    queryelems.append(order)
-    query = ' '.join(queryelems)
-    episodes = []
+    return ' '.join(queryelems), order, value
+
+def iterepisodes(db, idlist=None, podcasttitle=None, episodetitle=None):
+    """ Yield episodes matching all the given filters, one row at a time.
+    episodetitle searches episode titles and descriptions, and results are ordered best match first. """
+    fromwhere, order, value = episodequery(idlist=idlist, podcasttitle=podcasttitle, episodetitle=episodetitle)
     with db as conn:
-        curs = conn.execute(query, value)
-        for row in curs.fetchall():
-            episodes.append(Episode(**row))
-    return episodes
+        conn.row_factory = rowfactory(Episode)
+        yield from conn.execute('SELECT p.title as podtitle, e.* {} ORDER BY {}'.format(fromwhere, ', '.join(order)), value)
+
+def getepisodes(db, idlist=None, podcasttitle=None, episodetitle=None):
+    """ Return a list of the episodes matching all the given filters. """
+    return list(iterepisodes(db, idlist=idlist, podcasttitle=podcasttitle, episodetitle=episodetitle))
+
+def getepisodespodtitlelen(db, idlist=None, podcasttitle=None, episodetitle=None):
+    """ Return the length of the longest podcast title of the matching episodes, 0 if none match. """
+    fromwhere, _, value = episodequery(idlist=idlist, podcasttitle=podcasttitle, episodetitle=episodetitle)
+    with db as conn:
+        return conn.execute('SELECT IFNULL(MAX(LENGTH(p.title)), 0) ' + fromwhere, value).fetchone()[0]
 
 def getnewepisodes(db):
     """ Return all episodes that have no download orders. """
@@ -153,78 +349,240 @@ def getnewepisodes(db):
         queryelems.append(' AND '.join(where))
     queryelems.append(order)
     query = ' '.join(queryelems)
-    episodes = []
     with db as conn:
-        curs = conn.execute(query, value)
-        for row in curs.fetchall():
-            episodes.append(Episode(**row))
-    return episodes
+        conn.row_factory = rowfactory(Episode)
+        return conn.execute(query, value).fetchall()
 
-def getdls(db, podcasttitle=None, episodetitle=None, episodeids=None, statelist=None, newerthan=None):
-    queryelems = ['SELECT p.title as podtitle, e.title as eptitle, e.mediaurl, d.* FROM episode as e JOIN podcast as p USING(podcastid) JOIN dl as d USING(episodeid)']
-    order = 'ORDER BY podtitle, e.pubdate'
+def dlquery(podcasttitle=None, episodetitle=None, episodeids=None, statelist=None, newerthan=None, dlids=None, queued=False, podtitles=None):
+    """ Return the FROM and WHERE clauses, ORDER BY terms and values of a download query.
+    queued orders downloads as dl sync takes them, rather than by podcast. podtitles limits the query to the podcasts
+    with exactly those titles. """
+    queryelems = ['FROM episode as e JOIN podcast as p USING(podcastid) JOIN dl as d USING(episodeid)']
+    order = list(queueorder) if queued else ['podtitle', 'e.pubdate']
     where = []
     value = []
     if podcasttitle:
-        where.append('p.title LIKE ?')
-        value.append('%{}%'.format(podcasttitle))
+        term, values = podcastmatch(podcasttitle, 'p.')
+        where.append(term)
+        value.extend(values)
     if episodetitle:
-        where.append('e.title LIKE ?')
-        value.append('%{}%'.format(episodetitle))
+        addepisodematch(episodetitle, queryelems, where, value, order)
+    if podtitles:
+        where.append('p.title IN ({})'.format(('?,' * len(podtitles))[:-1]))
+        value.extend(podtitles)
     if episodeids:
         where.append('e.episodeid IN ({})'.format(('?,' * len(episodeids))[:-1]))
         value.extend(episodeids)
+    if dlids:
+        where.append('d.dlid IN ({})'.format(('?,' * len(dlids))[:-1]))
+        value.extend(dlids)
     if statelist:
         where.append('d.status IN (?)')
         value.append(','.join(statelist))
     if newerthan is not None:
         where.append('d.actioned > ?')
         value.append(newerthan)
-    # Build the query.
     if where:
         queryelems.append('WHERE')
         queryelems.append(' AND '.join(where))
-    queryelems.append(order)
-    query = ' '.join(queryelems)
-    dls = []
+    return ' '.join(queryelems), order, value
+
+def iterdls(db, podcasttitle=None, episodetitle=None, episodeids=None, statelist=None, newerthan=None, dlids=None, queued=False, podtitles=None):
+    """ Yield download orders matching all the given filters, one row at a time.
+    episodetitle searches episode titles and descriptions, and results are ordered best match first. """
+    fromwhere, order, value = dlquery(podcasttitle=podcasttitle, episodetitle=episodetitle, episodeids=episodeids, statelist=statelist, newerthan=newerthan, dlids=dlids, queued=queued, podtitles=podtitles)
+    with db as conn:
+        conn.row_factory = rowfactory(Download)
+        yield from conn.execute('SELECT p.title as podtitle, e.title as eptitle, e.mediaurl, e.medialength, p.priority as podpriority, d.* {} ORDER BY {}'.format(fromwhere, ', '.join(order)), value)
+
+def getdls(db, podcasttitle=None, episodetitle=None, episodeids=None, statelist=None, newerthan=None, dlids=None, queued=False, podtitles=None):
+    """ Return a list of the download orders matching all the given filters. """
+    return list(iterdls(db, podcasttitle=podcasttitle, episodetitle=episodetitle, episodeids=episodeids, statelist=statelist, newerthan=newerthan, dlids=dlids, queued=queued, podtitles=podtitles))
+
+def getdlspodtitlelen(db, podcasttitle=None, episodetitle=None, episodeids=None, statelist=None, newerthan=None, dlids=None):
+    """ Return the length of the longest podcast title of the matching download orders, 0 if none match. """
+    fromwhere, _, value = dlquery(podcasttitle=podcasttitle, episodetitle=episodetitle, episodeids=episodeids, statelist=statelist, newerthan=newerthan, dlids=dlids)
     with db as conn:
-        curs = conn.execute(query, value)
-        for row in curs.fetchall():
-            dls.append(Download(**row))
-    return dls
+        return conn.execute('SELECT IFNULL(MAX(LENGTH(p.title)), 0) ' + fromwhere, value).fetchone()[0]
 
-def markdl(db, dl, state, filename):
+def markdl(db, dl, state, filename, size=None, sha256=None):
     with db as conn:
-        conn.execute('UPDATE dl SET status = ?, actioned = ?, filename = ? WHERE dlid = ?', (state, int(time.time()), filename, dl.dlid))
+        conn.execute('UPDATE dl SET status = ?, actioned = ?, filename = ?, size = ?, sha256 = ?, leaseowner = NULL, leaseexpires = NULL WHERE dlid = ?', (state, int(time.time()), filename, size, sha256, dl.dlid))
         db.commit()
 
+def retrydl(db, dl, attempts):
+    """ Record a failed try at a download that stays waiting to be tried again. The lease is kept, so that the current
+    dl sync doesn't take the order again straight away. """
+    with db as conn:
+        conn.execute('UPDATE dl SET attempts = ?, actioned = ? WHERE dlid = ?', (attempts, int(time.time()), dl.dlid))
+        db.commit()
+
+def setdlfile(db, dl, size, sha256):
+    """ Record the size and digest of a download's file, eg as found by dl verify. """
+    with db as conn:
+        conn.execute('UPDATE dl SET size = ?, sha256 = ? WHERE dlid = ?', (size, sha256, dl.dlid))
+        db.commit()
+
+def requeuedls(db, dlids):
+    """ Return downloaded orders to the queue, eg when their files have gone missing. """
+    with db as conn:
+        conn.executemany("UPDATE dl SET status = 'w', actioned = NULL, filename = NULL, size = NULL, sha256 = NULL, attempts = 0 WHERE dlid = ?", [(x,) for x in dlids])
+        db.commit()
+
+def getdlcopies(db, dl, sha256=None):
+    """ Return other downloaded orders with a digest, either of the same episode as dl or with the digest sha256. """
+    where, value = ('d.sha256 = ?', sha256) if sha256 else ('d.episodeid = ?', dl.episodeid)
+    with db as conn:
+        conn.row_factory = rowfactory(Download)
+        return conn.execute("SELECT p.title as podtitle, d.* FROM dl as d JOIN episode as e USING(episodeid) JOIN podcast as p USING(podcastid) WHERE {} AND d.status = 'd' AND d.sha256 IS NOT NULL AND d.dlid != ? ORDER BY d.actioned DESC".format(where), (value, dl.dlid)).fetchall()
+
+def countdls(db, status):
+    with db as conn:
+        return conn.execute('SELECT COUNT(*) FROM dl WHERE status = ?', (status,)).fetchone()[0]
+
+def setdlpriority(db, dlids, priority):
+    """ Set the priority of download orders dlids, None to follow their podcasts' priority. """
+    with db as conn:
+        conn.executemany('UPDATE dl SET priority = ? WHERE dlid = ?', [(priority, x) for x in dlids])
+        db.commit()
+
+def getdlbytes(db, since, belowpriority):
+    """ Return the bytes downloaded since, by orders whose effective priority is below belowpriority. """
+    with db as conn:
+        return conn.execute("SELECT IFNULL(SUM(d.size), 0) FROM dl as d JOIN episode as e USING(episodeid) JOIN podcast as p USING(podcastid) WHERE d.status = 'd' AND d.actioned >= ? AND {} < ?".format(dlpriority), (since, belowpriority)).fetchone()[0]
+
+def claimdls(db, owner, limit, leasetime, minpriority=None):
+    """ Lease up to limit waiting downloads to owner for leasetime seconds, returns the leased download objects.
+    Orders are taken in queueorder, and only those of at least minpriority if given. Orders leased by another owner
+    are passed over until that lease expires. """
+    now = int(time.time())
+    where = ["d.status = 'w'", '(d.leaseexpires IS NULL OR d.leaseexpires < ?)']
+    values = [now]
+    if minpriority is not None:
+        where.append(dlpriority + ' >= ?')
+        values.append(minpriority)
+    with db as conn:
+        db.begin()
+        curs = conn.execute('SELECT d.dlid FROM dl as d JOIN episode as e USING(episodeid) JOIN podcast as p USING(podcastid) WHERE {} ORDER BY {} LIMIT ?'.format(' AND '.join(where), ', '.join(queueorder)), values + [limit])
+        dlids = [row[0] for row in curs.fetchall()]
+        conn.executemany('UPDATE dl SET leaseowner = ?, leaseexpires = ? WHERE dlid = ?', [(owner, now + leasetime, x) for x in dlids])
+        db.commit()
+    if dlids:
+        return getdls(db, dlids=dlids, queued=True)
+    return []
+
+def renewleases(db, owner, leasetime):
+    """ Extend owner's leases on its unfinished downloads. """
+    with db as conn:
+        conn.execute("UPDATE dl SET leaseexpires = ? WHERE leaseowner = ? AND status = 'w'", (int(time.time()) + leasetime, owner))
+        db.commit()
+
+def releaseleases(db, owner):
+    """ Return owner's unfinished downloads to the queue. """
+    with db as conn:
+        conn.execute("UPDATE dl SET leaseowner = NULL, leaseexpires = NULL WHERE leaseowner = ? AND status = 'w'", (owner,))
+        db.commit()
+
+def matchpodcasttitles(db, text):
+    """ Return the set of podcast titles matching the title search string text. """
+    with db as conn:
+        term, value = podcastmatch(text)
+        curs = conn.execute('SELECT title FROM podcast WHERE ' + term, value)
+        return frozenset(row[0] for row in curs)
+
+def matchepisoderanks(db, text):
+    """ Return a dict of episodeid to search rank for the episodes matching text, lower ranks are better matches. Text
+    without searchable words matches episode titles exactly. """
+    query = ftsquery(text)
+    with db as conn:
+        if not query:
+            curs = conn.execute('SELECT episodeid, 0 FROM episode WHERE title = ?', (text,))
+        else:
+            curs = conn.execute('SELECT rowid, rank FROM episodefts WHERE ' + episodematch, (query,))
+        return dict(curs.fetchall())
+
+def getlistspecs(db):
+    """ Return the saved listgen playlists. """
+    with db as conn:
+        return conn.execute('SELECT * FROM listspec ORDER BY filename').fetchall()
+
+def savelistspec(db, filename, podcast, episode, newerthan):
+    with db as conn:
+        conn.execute('INSERT OR REPLACE INTO listspec (filename, podcast, episode, newerthan) VALUES (?, ?, ?, ?)', (filename, podcast, episode, newerthan))
+        db.commit()
+
+def deletelistspec(db, filename):
+    with db as conn:
+        conn.execute('DELETE FROM listspec WHERE filename = ?', (filename,))
+        db.commit()
+
+def getplaylist(db, filename):
+    """ Return the tracked playlist written to filename, None if scoop hasn't written it. """
+    with db as conn:
+        conn.row_factory = rowfactory(Playlist)
+        return conn.execute('SELECT * FROM playlist WHERE filename = ?', (filename,)).fetchone()
+
+def getplaylistdlids(db, playlist):
+    """ Return the set of download order ids written to playlist. """
+    with db as conn:
+        curs = conn.execute('SELECT dlid FROM playlistentry WHERE playlistid = ?', (playlist.playlistid,))
+        return frozenset(row[0] for row in curs)
+
+def saveplaylist(db, filename, mtime, size, dlids, append=False):
+    """ Track the playlist file written to filename and the download orders in it.
+    With append, dlids are added to the playlist's entries rather than replacing them. """
+    with db as conn:
+        db.begin()
+        conn.execute('INSERT INTO playlist (filename, mtime, size) VALUES (?, ?, ?) ON CONFLICT (filename) DO UPDATE SET mtime = excluded.mtime, size = excluded.size', (filename, mtime, size))
+        playlistid = conn.execute('SELECT playlistid FROM playlist WHERE filename = ?', (filename,)).fetchone()[0]
+        if not append:
+            conn.execute('DELETE FROM playlistentry WHERE playlistid = ?', (playlistid,))
+        conn.executemany('INSERT OR IGNORE INTO playlistentry (playlistid, dlid) VALUES (?, ?)', [(playlistid, x) for x in dlids])
+        db.commit()
+
+def nextid(conn, table, idcolumn):
+    return conn.execute('SELECT IFNULL(MAX({}), 0) + 1 FROM {}'.format(idcolumn, table)).fetchone()[0]
+
 def addepisodes(db, podcast, episodedicts):
+    """ Add the episodes whose guids aren't already in the db, returns the new episode objects.
+    Known guids are found with a single query, and new rows are given their ids up front and inserted in one batch. """
     global addepsql
     newepisodes = []
+    episodedicts = list(episodedicts)
+    guids = [ep['guid'] for ep in episodedicts if ep['guid'] is not None]
     with db as conn:
+        db.begin()
+        curs = conn.execute('SELECT guid FROM episode WHERE guid IN (SELECT value FROM json_each(?))', (json.dumps(guids),))
+        seen = {row[0] for row in curs}
+        episodeid = nextid(conn, 'episode', 'episodeid')
         for ep in episodedicts:
-            ep['episodeid'] = None
+            if ep['guid'] is not None:
+                if ep['guid'] in seen:
+                    continue
+                # Feeds sometimes repeat an item, only the first is added.
+                seen.add(ep['guid'])
+            ep['episodeid'] = episodeid
             ep['podcastid'] = podcast.podcastid
-            cursor = conn.execute(addepsql, ep)
-            if cursor.rowcount == 0:
-                # Assume we've hit episodes that we've already entered.
-                break
-            ep['episodeid'] = cursor.lastrowid
             ep['podtitle'] = podcast.title
-            newepisodes.append(Episode(**ep))
-        if newepisodes:
-            db.commit()
-    return newepisodes
+            episodeid += 1
+            newepisodes.append(ep)
+        conn.executemany(addepsql, newepisodes)
+        db.commit()
+    return [Episode(**ep) for ep in newepisodes]
 
-def adddownloads(db, episodes, limit):
+def adddownloads(db, episodes, limit, priority=None):
+    """ Add download orders for episodes in one batch, returns the new download objects.
+    priority is that of the new orders, None to follow their podcast's priority. """
     global adddlsql
     newdownloads = []
+    added = int(time.time())
     with db as conn:
+        db.begin()
+        dlid = nextid(conn, 'dl', 'dlid')
         counter = collections.Counter()
         # SKIPPED is only for the initial import so podcasts with long history aren't fully downloaded.
         skippods = set()
         for ep in episodes:
-            added = int(time.time())
             actioned = None
             # Downloads only apply to media episodes so automatically skip non-media items, at least until
             # we provide some kind of action (eg, send-email) for non-media types.
@@ -245,14 +603,9 @@ def adddownloads(db, episodes, limit):
             if state == 's':
                 # SKIPPED is an end state so we'll set actioned to the order creation time.
                 actioned = added
-            # Insert a download workorder for the new episode.
-            dl = {'dlid': None, 'episodeid': ep.episodeid, 'status': state, 'added': added, 'actioned': actioned, 'filename': None}
-            cursor = conn.execute(adddlsql, dl)
-            dl['dlid'] = cursor.lastrowid
-            # And add some useful fields for printing.
-            dl['podtitle'] = ep.podtitle
-            dl['eptitle'] = ep.title
-            newdownloads.append(Download(**dl))
-        if newdownloads:
-            db.commit()
-    return newdownloads
+            # A download workorder for the new episode, plus some useful fields for printing.
+            newdownloads.append({'dlid': dlid, 'episodeid': ep.episodeid, 'status': state, 'added': added, 'actioned': actioned, 'filename': None, 'priority': priority, 'podtitle': ep.podtitle, 'eptitle': ep.title})
+            dlid += 1
+        conn.executemany(adddlsql, newdownloads)
+        db.commit()
+    return [Download(**dl) for dl in newdownloads]
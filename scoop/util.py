@@ -2,9 +2,83 @@
 Utility functions.
 Copyright (c) 2018 Akce. See LICENSE file for allowable usage.
 """
+import errno
+import hashlib
 import os
+import threading
+import time
 
-from . import sql
+def getdestdir(config, podtitle):
+    return os.path.join(config.downloaddir, podtitle)
 
-def getdestdir(db, podtitle):
-    return os.path.join(os.path.expanduser(sql.getconfig(db, 'downloaddir')['value']), podtitle)
+def getdlpath(config, dl):
+    """ Return the path of the downloaded media file of dl. """
+    return os.path.join(getdestdir(config, dl.podtitle), dl.filename)
+
+def hashfile(path, hasher=None, size=0x100000):
+    """ Add the contents of file path to hasher, a new sha256 if None, and return it. """
+    if hasher is None:
+        hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                return hasher
+            hasher.update(chunk)
+
+def linkfile(src, dst):
+    """ Replace dst with a hard link to src, in one step so that dst is never missing. Returns False if the files
+    can't be linked, eg they're on different filesystems, leaving dst as it was. """
+    if os.path.exists(dst) and os.path.samefile(src, dst):
+        return True
+    tmp = dst + '.link'
+    try:
+        os.link(src, tmp)
+    except OSError:
+        return False
+    os.replace(tmp, dst)
+    return True
+
+def preallocate(f, size):
+    """ Reserve disk space for open file f to grow to size bytes, so that it's laid out in one piece and a full disk is
+    found before downloading rather than part way. This extends the file, so it must be truncated to what was written.
+    Returns False if nothing was reserved, eg size is unknown or the filesystem doesn't support it. """
+    offset = f.tell()
+    if size is None or size <= offset or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), offset, size - offset)
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise
+        return False
+    return True
+
+def syncdir(path):
+    """ Flush directory path to disk, so that files renamed into it are kept after a crash. """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # Directories can't be opened on Windows.
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Throttle:
+    """ Bandwidth limiter that may be shared between threads.
+    Callers report bytes as they're transferred and are put to sleep to keep the combined rate under bytespersec. """
+
+    def __init__(self, bytespersec):
+        self.bytespersec = bytespersec
+        self._lock = threading.Lock()
+        # Time at which all bytes reported so far will have been paid for.
+        self._due = time.monotonic()
+
+    def consume(self, nbytes):
+        with self._lock:
+            now = time.monotonic()
+            self._due = max(self._due, now) + nbytes / self.bytespersec
+            delay = self._due - now
+        time.sleep(delay)
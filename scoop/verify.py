@@ -0,0 +1,96 @@
+"""
+Downloaded media checks: finds files that are missing, truncated or changed since they were downloaded.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+Each download records its file's size and sha256 digest. Files downloaded before digests were kept have theirs
+recorded the first time they're verified. Files are read and digested by a pool of threads, as hashlib releases the
+GIL while digesting.
+"""
+import collections
+import concurrent.futures as cf
+import os
+
+from . import sql
+from . import util
+
+# checkfile outcomes.
+OK = 'ok'
+NEW = 'new'
+MISSING = 'missing'
+SIZE = 'size'
+DIGEST = 'digest'
+
+problems = (MISSING, SIZE, DIGEST)
+
+Check = collections.namedtuple('Check', ['outcome', 'size', 'sha256'])
+
+def checkfile(path, size=None, sha256=None, quick=False):
+    """ Check the file at path against its recorded size and sha256 digest, either of which may be unknown. quick only
+    checks sizes, and digests a file only if its size is unknown. Returns a Check. """
+    try:
+        filesize = os.stat(path).st_size
+    except OSError:
+        return Check(MISSING, None, None)
+    if size is not None and filesize != size:
+        return Check(SIZE, filesize, None)
+    if quick and size is not None:
+        return Check(OK, filesize, sha256)
+    try:
+        digest = util.hashfile(path).hexdigest()
+    except OSError:
+        return Check(MISSING, None, None)
+    if sha256 is None:
+        return Check(NEW, filesize, digest)
+    return Check(OK if digest == sha256 else DIGEST, filesize, digest)
+
+def dedup(config, checked):
+    """ Hard-link files with the same digest to one copy. checked is a list of (download, Check). Returns the number of
+    files linked and the bytes freed. """
+    copies = collections.defaultdict(list)
+    for d, check in checked:
+        if check.outcome in (OK, NEW) and check.sha256:
+            copies[check.sha256].append(d)
+    linked = 0
+    freed = 0
+    for dls in copies.values():
+        # Keep the first download, the others link to it.
+        dls.sort(key=lambda d: d.actioned or 0)
+        keep = util.getdlpath(config, dls[0])
+        for d in dls[1:]:
+            path = util.getdlpath(config, d)
+            if os.path.samefile(keep, path):
+                continue
+            size = os.stat(path).st_size
+            if util.linkfile(keep, path):
+                linked += 1
+                freed += size
+    return linked, freed
+
+def verify(db, podcasttitle=None, episodetitle=None, jobs=4, quick=False, requeue=False, linkcopies=False):
+    """ Check the files of downloaded orders, printing any problems and a summary. requeue returns orders whose files
+    are missing or damaged to the download queue. linkcopies hard-links identical files to each other. Returns the
+    number of problems found. """
+    config = sql.loadconfig(db)
+    dls = [d for d in sql.getdls(db, podcasttitle=podcasttitle, episodetitle=episodetitle, statelist=['d']) if d.filename]
+    counts = collections.Counter()
+    checked = []
+    bad = []
+    with cf.ThreadPoolExecutor(max_workers=jobs) as executor:
+        checks = executor.map(lambda d: checkfile(util.getdlpath(config, d), d.size, d.sha256, quick), dls)
+        for d, check in zip(dls, checks):
+            counts[check.outcome] += 1
+            if check.outcome in problems:
+                bad.append(d.dlid)
+                print('{:8} {:32} {}'.format(check.outcome, d.podtitle, util.getdlpath(config, d)))
+            else:
+                if check.outcome == NEW:
+                    sql.setdlfile(db, d, check.size, check.sha256)
+                checked.append((d, check))
+    print('{} files: {} ok, {} digests recorded, {} missing, {} wrong size, {} changed'.format(len(dls), counts[OK], counts[NEW], counts[MISSING], counts[SIZE], counts[DIGEST]))
+    if requeue and bad:
+        sql.requeuedls(db, bad)
+        print('{} orders returned to the download queue'.format(len(bad)))
+    if linkcopies:
+        linked, freed = dedup(config, checked)
+        print('{} duplicate files linked, {:.1f} MiB freed'.format(linked, freed / 0x100000))
+    return len(bad)
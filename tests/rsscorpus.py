@@ -0,0 +1,68 @@
+"""
+Rss parser corpus checks, shared by tests/test_rssxml.py and benchmarks/rssparse.py: each backend must read the same
+episodes, channel and schedule hints as the etree backend from every feed in benchmarks/feeds.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+Each corpus feed is also read in small chunks, so that text split between chunks is covered.
+"""
+import glob
+import json
+import os
+import sys
+
+repodir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, repodir)
+from scoop import rssxml
+
+corpusdir = os.path.join(repodir, 'benchmarks', 'feeds')
+
+# The backend the others are checked against.
+reference = 'etree'
+
+# Chunk sizes each corpus feed is read in.
+chunksizes = (0x10000, 64, 7, 1)
+
+def parse(rssxmlbytes, backend, chunksize=0x10000):
+    """ Return what RssStream reads from rssxmlbytes: its episodes, channel, schedule hints and error, if any. """
+    stream = rssxml.RssStream(rssxml.chunked(rssxmlbytes, chunksize), backend=backend)
+    episodes = []
+    error = None
+    try:
+        for ep in stream.episodes():
+            episodes.append(ep)
+    except Exception as e:
+        # Only whether parsing failed is compared, backends raise different exceptions.
+        error = type(e).__name__
+    return dict(episodes=episodes, channel=stream.podcastdict(None), schedule=stream.schedule(), failed=error is not None, error=error)
+
+def differences(expected, got):
+    """ Return a description of each way that parse() result got differs from expected. """
+    diffs = []
+    for key in ('channel', 'schedule', 'failed'):
+        if got[key] != expected[key]:
+            diffs.append('{}: {!r} != {!r}'.format(key, got[key], expected[key]))
+    if len(got['episodes']) != len(expected['episodes']):
+        diffs.append('{} episodes != {}'.format(len(got['episodes']), len(expected['episodes'])))
+    for i, (g, e) in enumerate(zip(got['episodes'], expected['episodes'])):
+        for k in e:
+            if g.get(k) != e[k]:
+                diffs.append('episode {} {}: {!r} != {!r}'.format(i, k, g.get(k), e[k]))
+    return diffs
+
+def checkcorpus(backends, verbose=False):
+    """ Check backends against the reference on each corpus feed. Returns {feed: [difference, ...]}. """
+    results = {}
+    for path in sorted(glob.glob(os.path.join(corpusdir, '*.rss'))):
+        name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            rssxmlbytes = f.read()
+        if verbose:
+            print(json.dumps({name: parse(rssxmlbytes, reference)}, indent=2, ensure_ascii=False))
+        diffs = []
+        for size in chunksizes:
+            # How much of a broken feed is read before the error depends on the chunk size.
+            expected = parse(rssxmlbytes, reference, size)
+            for backend in backends:
+                diffs.extend('{} {} byte chunks: {}'.format(backend, size, d) for d in differences(expected, parse(rssxmlbytes, backend, size)))
+        results[name] = diffs
+    return results
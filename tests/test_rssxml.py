@@ -0,0 +1,23 @@
+"""
+Rss parser backend tests: each backend must read the same episodes, channel and schedule hints as the etree backend
+from every feed in the benchmarks/feeds corpus.
+Copyright (c) 2018 Acke, see LICENSE file for allowable usage.
+
+$ python3 -m unittest discover tests
+"""
+import unittest
+
+import rsscorpus
+from scoop import rssxml
+
+class TestBackends(unittest.TestCase):
+
+    def test_corpus(self):
+        results = rsscorpus.checkcorpus(sorted(rssxml.backends))
+        self.assertTrue(results, 'no feeds in {}'.format(rsscorpus.corpusdir))
+        for name, diffs in results.items():
+            with self.subTest(feed=name):
+                self.assertEqual(diffs, [])
+
+if __name__ == '__main__':
+    unittest.main()